@@ -1,12 +1,39 @@
+# --- Development entry point ---
+# `python MainServer.py` hands over to serve.py before any setup runs. Password pool workers
+# re-import the main script as __mp_main__, so it has to be the thin launcher rather than
+# this module (which would rebuild the app, writer and Socket.IO server in every worker).
+if __name__ == '__main__':
+    import runpy
+    import sys
+    from pathlib import Path
+    serve = str(Path(__file__).resolve().with_name('serve.py'))
+    sys.argv = [serve, '--mode', 'threading', '--debug', *sys.argv[1:]]
+    runpy.run_path(serve, run_name='__main__')
+    sys.exit()
+
 # --- Imports ---
-import grpc
-import service_pb2
-import service_pb2_grpc
-
-from flask import request, jsonify
-from flask_socketio import SocketIO, emit, disconnect
-from models import app, db, bcrypt, User, Message, Friendship 
-from sqlalchemy import or_ 
+import atexit
+import os
+import time
+from functools import wraps
+
+import base64
+import binascii
+from flask import request, jsonify, send_file, abort, g, has_request_context
+from flask_socketio import SocketIO, emit, disconnect, join_room
+from models import app, db, read_session, User, Message, Friendship, Conversation, DeliveryCursor, conversation_key, search_key
+from message_writer import MessageWriter, WriterBusy, WriteFailed
+from validation_client import UserValidationClient
+from socket_bus import create_client_manager
+from async_support import ASYNC_MODE, in_thread
+from avatar_store import AvatarStore, InvalidAvatar, avatar_url
+from friend_cache import FriendAdjacencyCache
+from password_hasher import PasswordHasher, HasherBusy
+from chat_codec import ENCODING_JSON, ENCODING_MSGPACK, negotiate, supported_encodings, pack_message, pack_batch, unpack_send
+from metrics import Registry, COUNT_BUCKETS, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from sql_profiler import SqlProfiler, ACTION_LOG
+from sqlalchemy import event, text, update
+from sqlalchemy.orm import load_only
 from flask_jwt_extended import (
     create_access_token, 
     JWTManager, 
@@ -22,23 +49,241 @@ app.config["JWT_TOKEN_LOCATION"] = ["headers"]
 app.config["JWT_HEADER_NAME"] = "Authorization"
 app.config["JWT_HEADER_TYPE"] = "Bearer"
 
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Message persistence (write-behind): 'enqueue' emits before commit, 'flush' after
+app.config["MESSAGE_DURABILITY"] = "enqueue"
+app.config["MESSAGE_BATCH_SIZE"] = 100
+app.config["MESSAGE_FLUSH_MS"] = 20
+app.config["MESSAGE_QUEUE_SIZE"] = 10000
+app.config["MESSAGE_DRAIN_FLUSH_MS"] = 2000  # connect waits this long for queued messages to commit
+
+# Multi-process: every worker needs a distinct WORKER_ID and the same message queue.
+# SOCKETIO_MESSAGE_QUEUE: '' (single process), 'sqlite:///path/bus.db' (local) or redis://...
+# Delivery never asks which worker holds a user's sockets: every emit goes to the user's
+# rooms and the message queue fans it out to the workers that have members in them.
+app.config["WORKER_ID"] = int(os.environ.get("WORKER_ID", "0"))
+app.config["SOCKETIO_MESSAGE_QUEUE"] = os.environ.get("SOCKETIO_MESSAGE_QUEUE", "")
+
+# Clients may opt in to msgpack chat events (see chat_codec.py); False forces JSON for everyone
+app.config["COMPACT_ENCODING_ENABLED"] = True
+
+# --- Metrics ---
+# GET /metrics (Prometheus text format), per worker. METRICS_ENABLED=0 installs none of
+# the hooks below; run benchmarks/bench_server.py with it on and off to see the overhead.
+app.config["METRICS_ENABLED"] = os.environ.get("METRICS_ENABLED", "1") != "0"
+
+server_metrics = Registry()
+http_latency = server_metrics.histogram('chat_http_request_duration_seconds', 'Flask request latency', ('route', 'method', 'status'))
+event_latency = server_metrics.histogram('chat_socketio_event_duration_seconds', 'Socket.IO event handler latency', ('event',))
+db_queries = server_metrics.histogram('chat_db_queries_per_request', 'SQL statements per request or socket event', ('handler',), buckets=COUNT_BUCKETS)
+persist_latency = server_metrics.histogram('chat_message_persist_seconds', 'Time from send_message to the commit of its batch')
+batch_commit_latency = server_metrics.histogram('chat_message_batch_commit_seconds', 'Write-behind batch commit time')
+grpc_latency = server_metrics.histogram('chat_grpc_client_duration_seconds', 'UserValidation call latency', ('method',))
+grpc_errors = server_metrics.counter('chat_grpc_client_errors_total', 'Failed UserValidation calls (DEADLINE_EXCEEDED = timeout)', ('method', 'code'))
+server_metrics.gauge('chat_online_sockets', 'Sockets connected to this worker', lambda: len(sid_to_user))
+
+def count_query(*_):
+    if has_request_context() and 'db_queries' in g: g.db_queries += 1
+
+def observe_message_commit(commit_seconds, latencies):
+    batch_commit_latency.observe(commit_seconds)
+    for seconds in latencies: persist_latency.observe(seconds)
+
+def observe_validation_rpc(method, seconds, code):
+    grpc_latency.observe(seconds, method)
+    if code != 'OK': grpc_errors.inc(method, code)
+
+if app.config["METRICS_ENABLED"]:
+    with app.app_context():
+        for engine in db.engines.values(): event.listen(engine, 'before_cursor_execute', count_query)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+        g.db_queries = 0
+
+    @app.after_request
+    def observe_request(resp):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_latency.observe(time.perf_counter() - g.request_start, route, request.method, resp.status_code)
+        db_queries.observe(g.db_queries, route)
+        return resp
+
+# --- SQL Profiler ---
+# Opt-in (SQL_PROFILE_ENABLED=1): per request/event query count, DB time and repeated
+# statement shapes, checked against the budget below; adds a Server-Timing header.
+app.config["SQL_PROFILE_ENABLED"] = os.environ.get("SQL_PROFILE_ENABLED", "0") == "1"
+app.config["SQL_PROFILE_MAX_QUERIES"] = 20
+app.config["SQL_PROFILE_MAX_REPEATS"] = 3  # same statement shape within one request: likely N+1
+app.config["SQL_PROFILE_MAX_DB_MS"] = 100
+app.config["SQL_PROFILE_ACTION"] = os.environ.get("SQL_PROFILE_ACTION", ACTION_LOG)  # 'log' or 'raise'
+
+sql_profiler = None
+if app.config["SQL_PROFILE_ENABLED"]:
+    sql_profiler = SqlProfiler(
+        max_queries=app.config["SQL_PROFILE_MAX_QUERIES"],
+        max_repeats=app.config["SQL_PROFILE_MAX_REPEATS"],
+        max_db_ms=app.config["SQL_PROFILE_MAX_DB_MS"],
+        action=app.config["SQL_PROFILE_ACTION"]
+    )
+    with app.app_context():
+        sql_profiler.install(db.engines.values())
+
+    @app.before_request
+    def start_sql_profile():
+        sql_profiler.start()
+
+    @app.after_request
+    def finish_sql_profile(resp):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        profile = sql_profiler.finish(f"{request.method} {route}")
+        if profile: resp.headers.add('Server-Timing', profile.server_timing())
+        return resp
+
+def instrumented(handler):
+    # Socket.IO handlers: latency and query count per event, and the SQL profile if enabled
+    if not app.config["METRICS_ENABLED"] and not sql_profiler: return handler
+
+    @wraps(handler)
+    def wrapper(*args):
+        g.db_queries = 0
+        if sql_profiler: sql_profiler.start()
+        start = time.perf_counter()
+        try: return handler(*args)
+        finally:
+            name = request.event['message']
+            if app.config["METRICS_ENABLED"]:
+                event_latency.observe(time.perf_counter() - start, name)
+                db_queries.observe(g.db_queries, name)
+            if sql_profiler: sql_profiler.finish(f"socket {name}")
+    return wrapper
+
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE, **create_client_manager(app.config["SOCKETIO_MESSAGE_QUEUE"]))
+
+message_writer = MessageWriter(
+    app,
+    batch_size=app.config["MESSAGE_BATCH_SIZE"],
+    flush_ms=app.config["MESSAGE_FLUSH_MS"],
+    queue_size=app.config["MESSAGE_QUEUE_SIZE"],
+    durability=app.config["MESSAGE_DURABILITY"],
+    worker_id=app.config["WORKER_ID"],
+    on_commit=observe_message_commit if app.config["METRICS_ENABLED"] else None,
+    on_failed=lambda row, error: notify_send_failed(row)
+)
+atexit.register(message_writer.stop)
+
+# gRPC user validation: pooled channels + ban verdict cache; fail policy 'open' or 'closed'
+app.config["GRPC_VALIDATION_TARGET"] = "localhost:50051"
+app.config["GRPC_VALIDATION_TIMEOUT"] = 2.0
+app.config["GRPC_CHANNEL_POOL_SIZE"] = 2
+app.config["BAN_CACHE_TTL"] = 30
+app.config["BAN_CACHE_SIZE"] = 10000
+app.config["BAN_FAIL_POLICY"] = "open"
+app.config["BAN_WATCH_ENABLED"] = True
+
+validation_client = UserValidationClient(
+    app.config["GRPC_VALIDATION_TARGET"],
+    timeout=app.config["GRPC_VALIDATION_TIMEOUT"],
+    pool_size=app.config["GRPC_CHANNEL_POOL_SIZE"],
+    cache_ttl=app.config["BAN_CACHE_TTL"],
+    cache_size=app.config["BAN_CACHE_SIZE"],
+    fail_policy=app.config["BAN_FAIL_POLICY"],
+    on_rpc=observe_validation_rpc if app.config["METRICS_ENABLED"] else None
+)
+atexit.register(validation_client.close)
+
+avatar_store = AvatarStore(app.config["AVATAR_STORE_DIR"])
+
+app.config["FRIEND_CACHE_TTL"] = 60
+app.config["FRIEND_CACHE_SIZE"] = 10000
+friend_cache = FriendAdjacencyCache(app.config["FRIEND_CACHE_TTL"], app.config["FRIEND_CACHE_SIZE"])
+
+# Password hashing runs in a process pool; changing BCRYPT_LOG_ROUNDS rehashes on next login
+app.config["BCRYPT_LOG_ROUNDS"] = 12
+app.config["PASSWORD_POOL_WORKERS"] = os.cpu_count() or 1
+app.config["PASSWORD_POOL_MAX_PENDING"] = 4 * app.config["PASSWORD_POOL_WORKERS"]
+
+password_hasher = PasswordHasher(
+    rounds=app.config["BCRYPT_LOG_ROUNDS"],
+    workers=app.config["PASSWORD_POOL_WORKERS"],
+    max_pending=app.config["PASSWORD_POOL_MAX_PENDING"]
+)
+atexit.register(password_hasher.close)
 
 # --- Global State (Online Users) ---
-user_to_sid = {} 
+# sid_to_user: sockets owned by this worker (bans kick local sockets; see user_room for delivery)
 sid_to_user = {} 
 
 # --- Helper Functions ---
+# Writer transactions (db.session) run through in_thread: under gevent/eventlet a wait for the
+# SQLite write lock, e.g. behind another worker's commit, would otherwise stall the whole hub.
+def commit_statement(stmt):
+    db.session.execute(stmt)
+    db.session.commit()
+
 def user_to_json(u):
     return {
         'id': u.id, 
         'username': u.username, 
         'display_name': u.display_name,
-        'avatar': u.avatar_base64
+        'avatar_hash': u.avatar_hash,
+        'avatar_url': avatar_url(u.avatar_hash)
     }
 
+def message_to_json(m):
+    return {'id': m.id, 'sender_id': m.sender_id, 'receiver_id': m.receiver_id, 'content': m.content, 'timestamp': m.timestamp.isoformat()}
+
+def user_room(user_id):
+    # Every socket of a user joins this room, so emits reach all their devices on any worker
+    return f'user:{user_id}'
+
+def message_room(user_id, encoding):
+    # Chat events are serialized per encoding, so sockets also join the room of the one they negotiated
+    return f'user:{user_id}:{encoding}'
+
+def emit_new_message(msg):
+    # One emit per encoding: the payload is serialized once and the same bytes go to every
+    # socket in the rooms. Sender's rooms double as the echo to all their devices.
+    user_ids = (msg.receiver_id, msg.sender_id)
+    socketio.emit('new_message', message_to_json(msg), to=[message_room(u, ENCODING_JSON) for u in user_ids])
+    if app.config["COMPACT_ENCODING_ENABLED"] and ENCODING_MSGPACK in supported_encodings():
+        socketio.emit('new_message', pack_message(msg), to=[message_room(u, ENCODING_MSGPACK) for u in user_ids])
+
+def notify_send_failed(row):
+    # 'enqueue' mode: the message was already emitted as sent; tell the sender's devices it was lost
+    socketio.emit('error', {'message': 'Message could not be saved', 'message_id': row['id'],
+                            'to_user_id': row['receiver_id']}, to=user_room(row['sender_id']))
+
+def kick_user(user_id, message):
+    # Each worker follows the ban stream itself, so only disconnect the local sockets
+    local_sids = [sid for sid, uid in list(sid_to_user.items()) if uid == user_id]
+    for sid in local_sids:
+        socketio.emit('error', {'message': message}, room=sid)
+        socketio.server.disconnect(sid, namespace='/')
+
+def on_ban_change(user_id, is_banned, message):
+    if is_banned: kick_user(user_id, message)
+
+def revalidate_online_users():
+    # Ban stream is down: sweep connected users with one batch RPC instead
+    online = set(sid_to_user.values())
+    if not online: return
+    verdicts = validation_client.check_many([(uid, '') for uid in online], apply_fail_policy=False)
+    for uid, (is_banned, message) in verdicts.items():
+        if is_banned: kick_user(uid, message)
+
+def start_background_services():
+    message_writer.start()
+    password_hasher.warm_up()
+    if app.config["BAN_WATCH_ENABLED"]:
+        validation_client.start_watch(on_ban_change, on_lost=revalidate_online_users)
+
 # --- API: Authentication ---
 
+def server_busy():
+    resp = jsonify({'error': 'Server busy, please retry'})
+    resp.headers['Retry-After'] = '1'
+    return resp, 503
+
 @app.route('/register', methods=['POST'])
 def register():
     data = request.get_json()
@@ -46,12 +291,23 @@ def register():
     if not all(k in data for k in required):
         return jsonify({'error': 'Missing required fields'}), 400
     
-    if User.query.filter_by(username=data['username']).first():
+    # Checked on a reader so the writer connection is not held while bcrypt runs
+    if read_session.query(User.id).filter_by(username=data['username']).first():
         return jsonify({'error': 'Username already exists'}), 409
-    if User.query.filter_by(email=data['email']).first():
+    if read_session.query(User.id).filter_by(email=data['email']).first():
         return jsonify({'error': 'Email already exists'}), 409
 
-    hashed_pw = bcrypt.generate_password_hash(data['password']).decode('utf-8')
+    avatar_hash = None
+    if data.get('avatar'):
+        try:
+            avatar_hash = avatar_store.put(base64.b64decode(data['avatar'], validate=True))
+        except (binascii.Error, InvalidAvatar) as e:
+            return jsonify({'error': f'Invalid avatar: {e}'}), 400
+
+    try:
+        hashed_pw = password_hasher.hash(data['password'])
+    except HasherBusy:
+        return server_busy()
     
     new_user = User(
         username=data['username'], 
@@ -60,12 +316,15 @@ def register():
         display_name=data['display_name'],
         gender=data.get('gender'),
         dob=data.get('dob'),
-        avatar_base64=data.get('avatar')
+        avatar_hash=avatar_hash
     )
     
-    try:
+    def insert_user():
         db.session.add(new_user)
         db.session.commit()
+
+    try:
+        in_thread(insert_user)
         return jsonify({'message': 'User created successfully'}), 201
     except Exception as e:
         db.session.rollback()
@@ -74,10 +333,17 @@ def register():
 @app.route('/login', methods=['POST'])
 def login():
     data = request.get_json()
-    user = User.query.filter_by(username=data['username']).first()
+    user = read_session.query(User).filter_by(username=data['username']).first()
 
-    if not user or not bcrypt.check_password_hash(user.password_hash, data['password']):
-        return jsonify({'error': 'Invalid credentials'}), 401
+    if not user: return jsonify({'error': 'Invalid credentials'}), 401
+    try:
+        if not password_hasher.check(data['password'], user.password_hash):
+            return jsonify({'error': 'Invalid credentials'}), 401
+        if password_hasher.needs_rehash(user.password_hash):
+            new_hash = password_hasher.hash(data['password'])
+            in_thread(commit_statement, update(User).where(User.id == user.id).values(password_hash=new_hash))
+    except HasherBusy:
+        return server_busy()
 
     access_token = create_access_token(identity=str(user.id))
     
@@ -87,41 +353,113 @@ def login():
         'user_id': user.id,
         'username': user.username,
         'display_name': user.display_name,
-        'avatar': user.avatar_base64
+        'avatar_hash': user.avatar_hash,
+        'avatar_url': avatar_url(user.avatar_hash)
     }), 200
 
+@app.route('/profile', methods=['POST'])
+@jwt_required()
+def update_profile():
+    data = request.get_json()
+    user_id = int(get_jwt_identity())
+    changes = {k: data[k] for k in ('display_name', 'gender', 'dob') if k in data}
+    if 'display_name' in changes and not changes['display_name']:
+        return jsonify({'error': 'display_name cannot be empty'}), 400
+    if 'display_name' in changes: changes['display_name_key'] = search_key(changes['display_name'])
+    if data.get('avatar'):
+        try:
+            changes['avatar_hash'] = avatar_store.put(base64.b64decode(data['avatar'], validate=True))
+        except (binascii.Error, InvalidAvatar) as e:
+            return jsonify({'error': f'Invalid avatar: {e}'}), 400
+    if not changes: return jsonify({'error': 'Nothing to update'}), 400
+
+    in_thread(commit_statement, update(User).where(User.id == user_id).values(**changes))
+    user = read_session.get(User, user_id)
+
+    # Everyone who shows this user in a sidebar: friends and both directions of pending requests
+    rooms = [user_room(uid) for uid in friend_cache.related_ids(user_id, load_friend_edges) | {user_id}]
+    socketio.emit('profile_changed', {'user': user_to_json(user)}, to=rooms)
+    return jsonify(user_to_json(user)), 200
+
+# --- API: Avatars ---
+
+@app.route('/avatars/<avatar_hash>/<variant>', methods=['GET'])
+def get_avatar(avatar_hash, variant):
+    # Content-addressed, so a URL never changes: strong ETag + cache forever
+    variant = int(variant) if variant.isdigit() else variant
+    path = avatar_store.path(avatar_hash, variant)
+    if not path: abort(404)
+    resp = send_file(path, mimetype='image/png', etag=f'{avatar_hash}-{variant}', max_age=31536000, conditional=True)
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+    return resp
+
 # --- API: Social Features ---
 
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 50
+SEARCH_CANDIDATES = 500
+
+# Candidates come from bounded index scans (username / display_name prefix on the search_key
+# columns, substring via the user_search trigram index), so cost does not grow with the
+# user table. They are then ranked and joined with the caller's relationship in one query:
+# exact username, username prefix, display_name prefix, then shorter (closer) usernames.
+SEARCH_QUERY = """
+    WITH candidate(id) AS (
+        SELECT id FROM (SELECT id FROM user WHERE username_key >= :q AND username_key < :q_hi
+                        ORDER BY username_key LIMIT :k)
+        UNION
+        SELECT id FROM (SELECT id FROM user WHERE display_name_key >= :q AND display_name_key < :q_hi
+                        ORDER BY display_name_key LIMIT :k)
+        {substring}
+    )
+    SELECT u.id, u.username, u.display_name, u.avatar_hash, f.status, f.receiver_id
+    FROM candidate c JOIN user u ON u.id = c.id
+    LEFT JOIN friendship f ON (f.sender_id = :me AND f.receiver_id = u.id)
+                           OR (f.sender_id = u.id AND f.receiver_id = :me)
+    WHERE u.id != :me
+    ORDER BY u.username_key = :q DESC,
+             u.username_key >= :q AND u.username_key < :q_hi DESC,
+             u.display_name_key >= :q AND u.display_name_key < :q_hi DESC,
+             length(u.username), u.id
+    LIMIT :limit OFFSET :offset
+"""
+SEARCH_PREFIX = text(SEARCH_QUERY.format(substring=""))
+# Trigrams need 3+ characters, so shorter queries only match on prefixes
+SEARCH_SUBSTRING = text(SEARCH_QUERY.format(
+    substring="UNION SELECT rowid FROM (SELECT rowid FROM user_search WHERE user_search MATCH :fts LIMIT :k)"))
+
 @app.route('/search_users', methods=['GET'])
 @jwt_required()
 def search_users():
-    query = request.args.get('q', '')
+    query = search_key(request.args.get('q', '').strip())
     current_user_id = int(get_jwt_identity())
+    limit = max(1, min(request.args.get('limit', SEARCH_DEFAULT_LIMIT, type=int), SEARCH_MAX_LIMIT))
+    offset = max(0, request.args.get('cursor', 0, type=int))
     if not query: return jsonify([]), 200
 
-    users = User.query.filter(
-        or_(User.username.contains(query), User.display_name.contains(query)),
-        User.id != current_user_id
-    ).all()
+    params = {'me': current_user_id, 'q': query, 'q_hi': query + '\uffff', 'k': SEARCH_CANDIDATES,
+              'limit': limit + 1, 'offset': offset}
+    if len(query) >= 3:
+        params['fts'] = '"' + query.replace('"', '""') + '"'
+        rows = read_session.execute(SEARCH_SUBSTRING, params).all()
+    else:
+        rows = read_session.execute(SEARCH_PREFIX, params).all()
 
     results = []
-    for u in users:
-        friendship = Friendship.query.filter(
-            ((Friendship.sender_id == current_user_id) & (Friendship.receiver_id == u.id)) |
-            ((Friendship.sender_id == u.id) & (Friendship.receiver_id == current_user_id))
-        ).first()
-        
-        status = 'none'
-        if friendship:
-            status = friendship.status
-            if status == 'pending' and friendship.receiver_id == current_user_id:
-                status = 'incoming_request' 
-
-        u_data = user_to_json(u)
-        u_data['status'] = status
-        results.append(u_data)
-    
-    return jsonify(results), 200
+    for row in rows[:limit]:
+        status = row.status or 'none'
+        if status == 'pending' and row.receiver_id == current_user_id:
+            status = 'incoming_request'
+        results.append({
+            'id': row.id, 'username': row.username, 'display_name': row.display_name,
+            'avatar_hash': row.avatar_hash, 'avatar_url': avatar_url(row.avatar_hash),
+            'status': status
+        })
+
+    resp = jsonify(results)
+    if len(rows) > limit: resp.headers['X-Next-Cursor'] = str(offset + limit)
+    return resp, 200
 
 @app.route('/friend_request', methods=['POST'])
 @jwt_required()
@@ -132,20 +470,22 @@ def send_friend_request():
 
     if not receiver_id or sender_id == receiver_id: return jsonify({'error': 'Invalid Request'}), 400
 
-    existing = Friendship.query.filter(
-        ((Friendship.sender_id == sender_id) & (Friendship.receiver_id == receiver_id)) |
-        ((Friendship.sender_id == receiver_id) & (Friendship.receiver_id == sender_id))
-    ).first()
+    def add_request():
+        # Checked inside the write transaction: two crossing requests cannot both pass
+        existing = Friendship.query.filter(
+            ((Friendship.sender_id == sender_id) & (Friendship.receiver_id == receiver_id)) |
+            ((Friendship.sender_id == receiver_id) & (Friendship.receiver_id == sender_id))
+        ).first()
+        if not existing: db.session.add(Friendship(sender_id=sender_id, receiver_id=receiver_id, status='pending'))
+        db.session.commit()
+        return not existing
 
-    if existing: return jsonify({'error': 'Relationship exists'}), 400
+    if not in_thread(add_request): return jsonify({'error': 'Relationship exists'}), 400
+    friend_cache.on_request(sender_id, receiver_id)
 
-    new_friendship = Friendship(sender_id=sender_id, receiver_id=receiver_id, status='pending')
-    db.session.add(new_friendship)
-    db.session.commit()
-
-    receiver_sid = user_to_sid.get(receiver_id)
-    if receiver_sid:
-        socketio.emit('new_friend_request', {'from_user': sender_id}, room=receiver_sid)
+    # The sender's profile rides along so the receiver can show it without a /pending_requests fetch
+    sender = read_session.get(User, sender_id)
+    socketio.emit('new_friend_request', {'from_user': sender_id, 'user': user_to_json(sender)}, to=user_room(receiver_id))
 
     return jsonify({'message': 'Request sent'}), 201
 
@@ -157,69 +497,277 @@ def respond_friend_request():
     sender_id = data.get('sender_id')
     action = data.get('action')
 
-    friendship = Friendship.query.filter_by(sender_id=sender_id, receiver_id=user_id, status='pending').first()
-    if not friendship: return jsonify({'error': 'Not found'}), 404
+    def respond():
+        friendship = Friendship.query.filter_by(sender_id=sender_id, receiver_id=user_id, status='pending').first()
+        if friendship and action == 'accept': friendship.status = 'accepted'
+        elif friendship and action == 'reject': db.session.delete(friendship)
+        db.session.commit()
+        return friendship is not None
+
+    if not in_thread(respond): return jsonify({'error': 'Not found'}), 404
 
     if action == 'accept':
-        friendship.status = 'accepted'
-        db.session.commit()
+        friend_cache.on_accept(sender_id, user_id)
+        # Each side (all devices) gets the other's profile to insert into its friend list
+        profiles = {u.id: user_to_json(u) for u in users_by_ids([sender_id, user_id])}
+        socketio.emit('friend_accepted', {'user': profiles.get(user_id)}, to=user_room(sender_id))
+        socketio.emit('friend_accepted', {'user': profiles.get(sender_id)}, to=user_room(user_id))
         return jsonify({'message': 'Accepted'}), 200
     elif action == 'reject':
-        db.session.delete(friendship)
-        db.session.commit()
+        friend_cache.on_remove(sender_id, user_id)
+        socketio.emit('friend_rejected', {'user_id': user_id}, to=user_room(sender_id))
+        socketio.emit('friend_rejected', {'user_id': sender_id}, to=user_room(user_id))
         return jsonify({'message': 'Rejected'}), 200
     
     return jsonify({'error': 'Invalid action'}), 400
 
-@app.route('/friends', methods=['GET'])
+@app.route('/friend_remove', methods=['POST'])
 @jwt_required()
-def get_friends():
+def remove_friend():
     user_id = int(get_jwt_identity())
-    friendships = Friendship.query.filter(
-        ((Friendship.sender_id == user_id) | (Friendship.receiver_id == user_id)) &
-        (Friendship.status == 'accepted')
+    friend_id = request.get_json().get('friend_id')
+
+    def delete_friendship():
+        friendship = Friendship.query.filter(
+            ((Friendship.sender_id == user_id) & (Friendship.receiver_id == friend_id)) |
+            ((Friendship.sender_id == friend_id) & (Friendship.receiver_id == user_id)),
+            Friendship.status == 'accepted'
+        ).first()
+        if friendship: db.session.delete(friendship)
+        db.session.commit()
+        return friendship is not None
+
+    if not in_thread(delete_friendship): return jsonify({'error': 'Not found'}), 404
+    friend_cache.on_remove(user_id, friend_id)
+    socketio.emit('friend_removed', {'user_id': user_id}, to=user_room(friend_id))
+    socketio.emit('friend_removed', {'user_id': friend_id}, to=user_room(user_id))
+    return jsonify({'message': 'Removed'}), 200
+
+def load_friend_edges(user_id):
+    return read_session.query(Friendship.sender_id, Friendship.receiver_id, Friendship.status).filter(
+        (Friendship.sender_id == user_id) | (Friendship.receiver_id == user_id)
     ).all()
 
-    friend_list = []
-    for f in friendships:
-        fid = f.receiver_id if f.sender_id == user_id else f.sender_id
-        fuser = db.session.get(User, fid)
-        if fuser: 
-            friend_list.append(user_to_json(fuser))
-            
-    return jsonify(friend_list), 200
+def users_by_ids(ids):
+    # One IN query for the whole list, loading only the columns user_to_json needs
+    if not ids: return []
+    return read_session.query(User).options(load_only(User.id, User.username, User.display_name, User.avatar_hash)).filter(
+        User.id.in_(ids)
+    ).order_by(User.display_name, User.id).all()
+
+@app.route('/friends', methods=['GET'])
+@jwt_required()
+def get_friends():
+    user_id = int(get_jwt_identity())
+    friend_ids = friend_cache.friend_ids(user_id, load_friend_edges)
+    return jsonify([user_to_json(u) for u in users_by_ids(friend_ids)]), 200
 
 @app.route('/pending_requests', methods=['GET'])
 @jwt_required()
 def get_pending_requests():
     user_id = int(get_jwt_identity())
-    reqs = Friendship.query.filter_by(receiver_id=user_id, status='pending').all()
-    result = []
-    for r in reqs:
-        s = db.session.get(User, r.sender_id)
-        if s: result.append(user_to_json(s))
-    return jsonify(result), 200
+    sender_ids = friend_cache.incoming_ids(user_id, load_friend_edges)
+    return jsonify([user_to_json(u) for u in users_by_ids(sender_ids)]), 200
 
 # --- API: Chat History ---
 
+HISTORY_DEFAULT_LIMIT = 50
+HISTORY_MAX_LIMIT = 200
+
+def conversation_page(user_a, user_b, before_id=None, after_id=None, limit=HISTORY_DEFAULT_LIMIT):
+    # One bounded range scan per direction on ix_message_conversation, merged in Python,
+    # so the cost is O(limit) regardless of conversation or table size. A chat with
+    # yourself has only one direction.
+    newest_first = after_id is None
+    directions = [(user_a, user_b)] if user_a == user_b else [(user_a, user_b), (user_b, user_a)]
+    pages = []
+    for s_id, r_id in directions:
+        q = read_session.query(Message).filter(Message.sender_id == s_id, Message.receiver_id == r_id)
+        if before_id is not None: q = q.filter(Message.id < before_id)
+        if after_id is not None: q = q.filter(Message.id > after_id)
+        q = q.order_by(Message.id.desc() if newest_first else Message.id.asc())
+        pages.append(q.limit(limit).all())
+
+    merged = sorted((m for page in pages for m in page), key=lambda m: m.id, reverse=newest_first)[:limit]
+    if newest_first: merged.reverse()
+    return merged
+
 @app.route('/chat_history/<int:other_user_id>', methods=['GET'])
 @jwt_required()
 def get_chat_history(other_user_id):
     current_user_id = int(get_jwt_identity())
-    messages = Message.query.filter(
-        ((Message.sender_id == current_user_id) & (Message.receiver_id == other_user_id)) |
-        ((Message.sender_id == other_user_id) & (Message.receiver_id == current_user_id))
-    ).order_by(Message.timestamp.asc()).all()
-    
-    message_list = [
-        {'id': m.id, 'sender_id': m.sender_id, 'receiver_id': m.receiver_id, 'content': m.content, 'timestamp': m.timestamp.isoformat()} 
-        for m in messages
-    ]
-    return jsonify(message_list), 200
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('limit', HISTORY_DEFAULT_LIMIT, type=int)
+    if before_id is not None and after_id is not None:
+        return jsonify({'error': 'Use either before_id or after_id'}), 400
+    limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+
+    messages = conversation_page(current_user_id, other_user_id, before_id, after_id, limit)
+    return jsonify([message_to_json(m) for m in messages]), 200
+
+SYNC_DEFAULT_LIMIT = 200
+SYNC_MAX_LIMIT = 1000
+
+def message_head(user_id):
+    # Newest message id to or from the user
+    head = [read_session.query(db.func.max(Message.id)).filter(col == user_id).scalar() or 0
+            for col in (Message.sender_id, Message.receiver_id)]
+    return max(head)
+
+def messages_since(user_id, since_id, limit):
+    # All of the user's messages with id > since_id, oldest first, from two range scans
+    # (ix_message_sender / ix_message_receiver). Returns (messages, has_more).
+    pages = {}
+    for col in (Message.sender_id, Message.receiver_id):
+        q = read_session.query(Message).filter(col == user_id, Message.id > since_id)
+        for m in q.order_by(Message.id.asc()).limit(limit + 1): pages[m.id] = m
+    merged = sorted(pages.values(), key=lambda m: m.id)
+    return merged[:limit], len(merged) > limit
+
+@app.route('/messages', methods=['GET'])
+@jwt_required()
+def get_messages_since():
+    # Delta sync over all of the caller's conversations. Without since_id only the cursor is
+    # returned: the newest message id to sync from.
+    current_user_id = int(get_jwt_identity())
+    since_id = request.args.get('since_id', type=int)
+    limit = max(1, min(request.args.get('limit', SYNC_DEFAULT_LIMIT, type=int), SYNC_MAX_LIMIT))
+
+    if since_id is None:
+        return jsonify({'messages': [], 'cursor': message_head(current_user_id), 'has_more': False}), 200
+
+    messages, has_more = messages_since(current_user_id, since_id, limit)
+    cursor = messages[-1].id if messages else since_id
+    return jsonify({'messages': [message_to_json(m) for m in messages], 'cursor': cursor,
+                    'has_more': has_more}), 200
+
+# --- Offline Delivery ---
+# Each device has a delivered watermark (DeliveryCursor). On connect it gets everything to or
+# from its user after that watermark in 'message_batch' events of DRAIN_BATCH_SIZE; the client
+# answers each with one cumulative 'ack', which moves the watermark and pulls the next batch.
+# Live messages are acked the same way, a batch at a time. Watermarks are kept by the
+# message writer and saved with its batches, so acks never wait on the writer connection.
+# A watermark never passes a message the device could still miss: acks are clamped to what
+# was sent or committed, and the drain waits for this worker's queued messages.
+DRAIN_BATCH_SIZE = 500
+DRAIN_OVERLAP_IDS = 5000 << 22  # first batch starts ~5 s back: other workers may commit out of id order
+
+def drain_start(watermark):
+    # Only snowflake ids carry a time; ids from before them (autoincrement) are used as is
+    return max(0, watermark - DRAIN_OVERLAP_IDS) if watermark >> 22 else watermark
+
+sid_to_device = {}  # sid -> {'user_id', 'device_id', 'encoding', 'pending': cursor of an unacked batch with more after it,
+                   #         'sent': newest batch cursor sent, 'ceiling': acks stop here (messages missing from the drain)}
+
+def delivered_watermark(user_id, device_id, hint=None):
+    noted = message_writer.delivered(user_id, device_id)
+    if noted is not None: return noted
+    cursor = read_session.get(DeliveryCursor, (user_id, device_id))
+    if cursor: return cursor.delivered_id
+    # First connect of this device: start after what its local copy already has, else from now
+    head = message_head(user_id)
+    start = min(hint, head) if isinstance(hint, int) and not isinstance(hint, bool) and hint >= 0 else head
+    message_writer.note_delivered(user_id, device_id, start)
+    return start
+
+def push_message_batch(state, since_id):
+    messages, has_more = messages_since(state['user_id'], since_id, DRAIN_BATCH_SIZE)
+    cursor = messages[-1].id if messages else since_id
+    if state['encoding'] == ENCODING_MSGPACK:
+        emit('message_batch', pack_batch(messages, cursor, has_more))
+    else:
+        emit('message_batch', {'messages': [message_to_json(m) for m in messages], 'cursor': cursor, 'has_more': has_more})
+    state['pending'] = cursor if has_more else None
+    state['sent'] = max(state['sent'], cursor)
+
+# --- API: Conversations ---
+
+INBOX_DEFAULT_LIMIT = 50
+INBOX_MAX_LIMIT = 200
+
+def conversation_to_json(c, user_id, peer):
+    return {
+        'user': user_to_json(peer),
+        'last_message': {'id': c.last_message_id, 'sender_id': c.last_sender_id,
+                         'preview': c.last_preview, 'timestamp': c.last_timestamp.isoformat()},
+        'unread': c.unread_a if c.user_a_id == user_id else c.unread_b,
+    }
+
+@app.route('/conversations', methods=['GET'])
+@jwt_required()
+def get_conversations():
+    # Inbox, most recent first: one bounded range scan per side of the Conversation table
+    # (the caller is user_a in some rows and user_b in others), merged like conversation_page
+    user_id = int(get_jwt_identity())
+    limit = max(1, min(request.args.get('limit', INBOX_DEFAULT_LIMIT, type=int), INBOX_MAX_LIMIT))
+    before_id = request.args.get('cursor', type=int)
+
+    rows = []
+    for col in (Conversation.user_a_id, Conversation.user_b_id):
+        q = read_session.query(Conversation).filter(col == user_id)
+        if col is Conversation.user_b_id: q = q.filter(Conversation.user_a_id != user_id)  # self-chat: once
+        if before_id is not None: q = q.filter(Conversation.last_message_id < before_id)
+        rows += q.order_by(Conversation.last_message_id.desc()).limit(limit + 1).all()
+    rows.sort(key=lambda c: c.last_message_id, reverse=True)
+    page = rows[:limit]
+
+    peer_of = lambda c: c.user_b_id if c.user_a_id == user_id else c.user_a_id
+    peers = {u.id: u for u in users_by_ids([peer_of(c) for c in page])}
+    results = [conversation_to_json(c, user_id, peers[peer_of(c)]) for c in page if peer_of(c) in peers]
+    resp = jsonify(results)
+    if len(rows) > limit: resp.headers['X-Next-Cursor'] = str(page[-1].last_message_id)
+    return resp, 200
+
+@app.route('/conversations/<int:other_user_id>/read', methods=['POST'])
+@jwt_required()
+def mark_conversation_read(other_user_id):
+    # Body: {'last_read_id': <newest message id the client has shown>}, default: the last message.
+    # Unread is recounted from the messages after it, inside the writer transaction so a batch
+    # committed in between cannot be lost (and later ones only count if newer than the mark)
+    user_id = int(get_jwt_identity())
+    data = request.get_json(silent=True) or {}
+    if 'last_read_id' in data and (not isinstance(data['last_read_id'], int) or isinstance(data['last_read_id'], bool)):
+        return jsonify({'error': 'last_read_id must be an integer'}), 400
+    a, b = conversation_key(user_id, other_user_id)
+
+    def mark_read():
+        conv = db.session.get(Conversation, (a, b))
+        if not conv:
+            db.session.commit()
+            return None
+        last_read_id = data.get('last_read_id', conv.last_message_id)
+        is_a = user_id == a
+        read_upto = conv.read_upto_a if is_a else conv.read_upto_b
+        if last_read_id > read_upto:
+            unread = db.session.query(db.func.count(Message.id)).filter(
+                Message.sender_id == other_user_id, Message.receiver_id == user_id, Message.id > last_read_id
+            ).scalar()
+            if is_a: conv.read_upto_a, conv.unread_a = last_read_id, unread
+            else: conv.read_upto_b, conv.unread_b = last_read_id, unread
+        unread = conv.unread_a if is_a else conv.unread_b
+        db.session.commit()
+        return unread
+
+    unread = in_thread(mark_read)
+    if unread is None:
+        return jsonify({'user_id': other_user_id, 'unread': 0}), 200
+
+    # The caller's other devices clear their badge too
+    socketio.emit('conversation_read', {'user_id': other_user_id, 'unread': unread}, to=user_room(user_id))
+    return jsonify({'user_id': other_user_id, 'unread': unread}), 200
+
+# --- API: Metrics ---
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not app.config["METRICS_ENABLED"]: abort(404)
+    return server_metrics.render(), 200, {'Content-Type': METRICS_CONTENT_TYPE}
 
 # --- WebSocket Events ---
 
 @socketio.on('connect')
+@instrumented
 def handle_connect(auth): 
     print(f"Client connecting: {request.sid}")
     token = auth.get('token')
@@ -230,7 +778,7 @@ def handle_connect(auth):
     try:
         payload = decode_token(token)
         user_id = int(payload['sub'])
-        user = db.session.get(User, user_id)
+        user = read_session.get(User, user_id)
         if not user: raise Exception("User not found")
     except Exception as e:
         print(f"Auth Fail: {e}")
@@ -238,58 +786,75 @@ def handle_connect(auth):
         return
 
     # gRPC Validation
-    try:
-        with grpc.insecure_channel('localhost:50051') as channel:
-            stub = service_pb2_grpc.UserValidationStub(channel)
-            req = service_pb2.UserRequest(user_id=user.id, username=user.username)
-            resp = stub.CheckUserStatus(req, timeout=2.0)
-            if resp.is_banned:
-                emit('error', {'message': resp.message})
-                disconnect()
-                return
-    except: pass 
-
-    user_to_sid[user_id] = request.sid
+    is_banned, ban_message = validation_client.check(user.id, user.username)
+    if is_banned:
+        emit('error', {'message': ban_message})
+        disconnect()
+        return
+
+    encoding = negotiate(auth.get('encoding'), app.config["COMPACT_ENCODING_ENABLED"])
+    join_room(user_room(user_id))
+    join_room(message_room(user_id, encoding))
+    emit('session', {'encoding': encoding, 'drain': True})
     sid_to_user[request.sid] = user_id
     print(f"User {user.id} connected")
 
+    # Catch up on what this device missed while offline
+    state = {'user_id': user_id, 'device_id': str(auth.get('device') or '')[:64], 'encoding': encoding,
+             'pending': None, 'sent': 0, 'ceiling': None}
+    # Messages queued here must be in the drain, or acking later live ones would skip them.
+    # If the writer is stuck, acks on this socket stay below the ones it still holds.
+    if not message_writer.flush(app.config["MESSAGE_DRAIN_FLUSH_MS"] / 1000.0):
+        oldest = message_writer.oldest_pending()
+        if oldest is not None: state['ceiling'] = oldest - 1
+    read_session.rollback()  # new snapshot: the user lookup above predates that commit
+    sid_to_device[request.sid] = state
+    watermark = delivered_watermark(user_id, state['device_id'], auth.get('delivered'))
+    push_message_batch(state, drain_start(watermark))
+
 @socketio.on('disconnect')
-def handle_disconnect():
+@instrumented
+def handle_disconnect(reason=None):
     sid = request.sid
-    user_id = sid_to_user.get(sid)
-    if user_id:
-        if user_to_sid.get(user_id) == sid:
-            del user_to_sid[user_id]
-        del sid_to_user[sid]
+    sid_to_user.pop(sid, None)
+    sid_to_device.pop(sid, None)
+
+@socketio.on('ack')
+@instrumented
+def handle_ack(data):
+    # Cumulative: everything up to data['cursor'] reached this device
+    state = sid_to_device.get(request.sid)
+    cursor = data.get('cursor') if isinstance(data, dict) else None
+    if not state or not isinstance(cursor, int) or isinstance(cursor, bool): return
+    # Past the last batch only live messages can be acked, and those are the user's messages
+    delivered = cursor
+    if delivered > state['sent']: delivered = max(state['sent'], min(delivered, message_head(state['user_id'])))
+    if state['ceiling'] is not None: delivered = min(delivered, state['ceiling'])
+    message_writer.note_delivered(state['user_id'], state['device_id'], delivered)
+    if state['pending'] is not None and cursor >= state['pending']:
+        push_message_batch(state, state['pending'])
 
 @socketio.on('send_message')
+@instrumented
 def handle_send_message(data):
     sender_sid = request.sid
     sender_id = sid_to_user.get(sender_sid)
     if not sender_id: return
 
+    if isinstance(data, bytes):  # compact encoding
+        try: data = unpack_send(data)
+        except Exception: return
     receiver_id = data.get('to_user_id')
     content = data.get('content')
+    if not isinstance(receiver_id, int) or isinstance(receiver_id, bool) or not content: return
     
     try:
-        new_msg = Message(sender_id=sender_id, receiver_id=receiver_id, content=content)
-        db.session.add(new_msg)
-        db.session.commit()
-    except:
-        db.session.rollback()
+        new_msg = message_writer.submit(sender_id, receiver_id, content)
+    except WriterBusy:
+        emit('error', {'message': 'Server busy, message not sent'})
+        return
+    except WriteFailed:
+        emit('error', {'message': 'Message could not be saved'})
         return
 
-    payload = {
-        'id': new_msg.id, 'sender_id': sender_id, 'receiver_id': receiver_id, 
-        'content': content, 'timestamp': new_msg.timestamp.isoformat()
-    }
-
-    receiver_sid = user_to_sid.get(receiver_id)
-    if receiver_sid:
-        socketio.emit('new_message', payload, room=receiver_sid)
-    emit('new_message', payload)
-
-# --- Main Execution ---
-if __name__ == '__main__':
-    print("Server running on http://127.0.0.1:8000")
-    socketio.run(app, host='127.0.0.1', port=8000, debug=True, allow_unsafe_werkzeug=True)
\ No newline at end of file
+    emit_new_message(new_msg)
@@ -0,0 +1,41 @@
+import contextvars
+import functools
+import os
+
+# --- Async mode ---
+# MainServer runs under 'threading' (Werkzeug dev server), 'gevent' or 'eventlet'.
+# serve.py sets CHAT_ASYNC_MODE and monkey patches before MainServer is imported.
+
+ASYNC_MODE = os.environ.get('CHAT_ASYNC_MODE', 'threading')
+ASYNC_MODES = ('threading', 'gevent', 'eventlet')
+
+if ASYNC_MODE not in ASYNC_MODES:
+    raise ValueError(f"CHAT_ASYNC_MODE must be one of {ASYNC_MODES}, got {ASYNC_MODE!r}")
+
+
+def offload(fn, *args, **kwargs):
+    """Run a call that blocks in C code (gRPC) without stalling the event loop.
+
+    gRPC is made cooperative under gevent by grpc.experimental.gevent.init_gevent(),
+    but under eventlet it must run on a real OS thread from eventlet's tpool.
+    """
+    if ASYNC_MODE == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
+
+
+def in_thread(fn, *args, **kwargs):
+    """Run a call on a real OS thread (gevent's threadpool / eventlet's tpool) and wait for it.
+
+    For SQLite writes: waiting for the write lock (busy_timeout) blocks in C, which on the
+    hub would stall every socket of the worker. The call sees the caller's context
+    variables, so Flask's app/request context and db.session are the caller's.
+    """
+    if ASYNC_MODE == 'threading': return fn(*args, **kwargs)
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    if ASYNC_MODE == 'gevent':
+        import gevent
+        return gevent.get_hub().threadpool.apply(call)
+    from eventlet import tpool
+    return tpool.execute(call)
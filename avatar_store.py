@@ -0,0 +1,64 @@
+import hashlib
+import io
+import os
+import tempfile
+
+from PIL import Image
+
+# --- Content-addressed avatar store ---
+# Avatars live on disk under <root>/<hash[:2]>/<hash>/<size>.png, where hash is the
+# SHA-256 of the uploaded image. Variants are pre-rendered at the sizes the client
+# draws, so API responses only carry the hash and files are immutable per URL.
+
+AVATAR_SIZES = (30, 35, 40, 45)
+ORIGINAL = 'orig'
+MAX_UPLOAD_BYTES = 2 * 1024 * 1024
+
+
+class InvalidAvatar(Exception):
+    pass
+
+
+class AvatarStore:
+    def __init__(self, root):
+        self.root = root
+
+    def _dir(self, avatar_hash):
+        return os.path.join(self.root, avatar_hash[:2], avatar_hash)
+
+    def path(self, avatar_hash, variant):
+        if len(avatar_hash) != 64 or not all(c in '0123456789abcdef' for c in avatar_hash): return None
+        if variant != ORIGINAL and variant not in AVATAR_SIZES: return None
+        path = os.path.join(self._dir(avatar_hash), f'{variant}.png')
+        return path if os.path.exists(path) else None
+
+    def put(self, image_bytes):
+        """Store an uploaded image with all its size variants and return its hash."""
+        if len(image_bytes) > MAX_UPLOAD_BYTES: raise InvalidAvatar("Avatar is too large")
+        avatar_hash = hashlib.sha256(image_bytes).hexdigest()
+        target = self._dir(avatar_hash)
+        if os.path.exists(os.path.join(target, f'{ORIGINAL}.png')): return avatar_hash
+
+        try:
+            img = Image.open(io.BytesIO(image_bytes))
+            img.load()
+        except Exception as e:
+            raise InvalidAvatar(f"Invalid image: {e}")
+        img = img.convert('RGBA')
+
+        os.makedirs(target, exist_ok=True)
+        for size in AVATAR_SIZES:
+            self._write(target, size, img.resize((size, size), Image.Resampling.LANCZOS))
+        # Original last: its presence marks the avatar as complete
+        self._write(target, ORIGINAL, img)
+        return avatar_hash
+
+    def _write(self, target, variant, img):
+        fd, tmp = tempfile.mkstemp(dir=target, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            img.save(f, format='PNG', optimize=True)
+        os.replace(tmp, os.path.join(target, f'{variant}.png'))
+
+
+def avatar_url(avatar_hash, size=ORIGINAL):
+    return f'/avatars/{avatar_hash}/{size}' if avatar_hash else None
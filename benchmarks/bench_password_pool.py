@@ -0,0 +1,46 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from password_hasher import PasswordHasher, _hash_password
+
+# --- Login throughput vs. password pool size ---
+# Each "login" is one bcrypt check, the part of /login that dominates its cost.
+# Run: python benchmarks/bench_password_pool.py --rounds 12 --logins 64
+
+
+def bench(workers, rounds, logins, hashed):
+    hasher = PasswordHasher(rounds=rounds, workers=workers, max_pending=logins)
+    hasher.warm_up()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=logins) as clients:
+        ok = all(clients.map(lambda _: hasher.check('secret-password', hashed), range(logins)))
+    elapsed = time.perf_counter() - start
+    hasher.close()
+    assert ok
+    return logins / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--logins', type=int, default=64)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    hashed = _hash_password('secret-password', args.rounds)
+    sizes = sorted({1, 2, 4, 8, 16, args.max_workers} & set(range(1, args.max_workers + 1)))
+    baseline = None
+    print(f"bcrypt rounds={args.rounds}, {args.logins} concurrent logins, {os.cpu_count()} CPUs")
+    print(f"{'workers':>8} {'logins/s':>10} {'speedup':>8}")
+    for workers in sizes:
+        rate = bench(workers, args.rounds, args.logins, hashed)
+        baseline = baseline or rate
+        print(f"{workers:>8} {rate:>10.1f} {rate / baseline:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
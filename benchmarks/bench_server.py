@@ -0,0 +1,312 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# --- MainServer endpoint / socket event benchmarks ---
+# Seeds a fresh chat.db through models at a configurable scale, then times the handlers
+# in-process with Flask's test client and the Socket.IO test client (no network, no
+# gRPC server needed: ban checks fail open). Results are JSON; --save keeps them as a
+# baseline and --compare flags operations that got slower than the baseline.
+# Run: python benchmarks/bench_server.py --save benchmarks/baselines/local.json
+#      python benchmarks/bench_server.py --compare benchmarks/baselines/local.json
+
+PASSWORD = 'bench-password'
+PERCENTILES = (50, 95, 99)
+SEED_CHUNK = 10000
+SEED_SPAN_MS = 30 * 24 * 3600 * 1000  # seeded messages are spread over the last 30 days
+SEED_WORKER_ID = 1023  # snowflake worker id for seeded messages; the server uses WORKER_ID (0)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--friends', type=int, default=10, help='friends per user (even)')
+    parser.add_argument('--pending', type=int, default=3, help='incoming friend requests per user')
+    parser.add_argument('--messages', type=int, default=50, help='messages per conversation')
+    parser.add_argument('--iterations', type=int, default=300)
+    parser.add_argument('--auth-iterations', type=int, default=10, help='for register/login (bcrypt bound)')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', help='comma-separated benchmark names')
+    parser.add_argument('--workdir', help='where the fresh chat.db goes (default: a temp dir, removed afterwards)')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    parser.add_argument('--load', help='compare these saved results instead of running')
+    parser.add_argument('--metric', default='p50_ms', choices=[f'p{p}_ms' for p in PERCENTILES] + ['mean_ms'])
+    parser.add_argument('--threshold', type=float, default=0.10, help='allowed slowdown before flagging, 0.10 = 10%%')
+    return parser.parse_args()
+
+
+def percentile(sorted_samples, p):
+    # nearest-rank
+    k = max(0, min(len(sorted_samples) - 1, int(round(p / 100 * len(sorted_samples) + 0.5)) - 1))
+    return sorted_samples[k]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    result = {'iterations': len(samples), 'mean_ms': round(sum(samples) / len(samples) * 1000, 3)}
+    for p in PERCENTILES: result[f'p{p}_ms'] = round(percentile(samples, p) * 1000, 3)
+    result['ops_per_s'] = round(len(samples) / sum(samples), 1)
+    return result
+
+
+def measure(fn, iterations, warmup):
+    for _ in range(warmup): fn()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def expect(resp, status):
+    if resp.status_code != status:
+        raise RuntimeError(f"{resp.request.path}: expected {status}, got {resp.status_code} {resp.get_data(as_text=True)[:200]}")
+
+
+# --- Seeding ---
+
+def friend_graph(n, friends, pending):
+    """(accepted pairs, pending (sender, receiver) pairs) over user indexes 0..n-1.
+
+    Ring lattice: user i is friends with the friends/2 users after it, and gets requests
+    from the `pending` users after those.
+    """
+    half = friends // 2
+    seen, accepted, requests = set(), [], []
+    for i in range(n):
+        for d in range(1, half + 1):
+            pair = (i, (i + d) % n)
+            if pair[0] != pair[1] and frozenset(pair) not in seen:
+                seen.add(frozenset(pair))
+                accepted.append(pair)
+    for i in range(n):
+        for d in range(half + 1, half + pending + 1):
+            pair = ((i + d) % n, i)
+            if pair[0] != pair[1] and frozenset(pair) not in seen:
+                seen.add(frozenset(pair))
+                requests.append(pair)
+    return accepted, requests
+
+
+def seed(args, rng, db, password_hash):
+    from sqlalchemy import insert
+    from message_writer import SnowflakeIds
+    from models import User, Friendship, Message, install_search_index, update_conversations
+
+    db.create_all()
+    install_search_index()
+
+    users = [{'username': f'bench{i:06d}', 'email': f'bench{i:06d}@bench.local', 'display_name': f'Bench User {i}',
+              'password_hash': password_hash} for i in range(args.users)]
+    db.session.execute(insert(User), users)
+    ids = [row.id for row in db.session.query(User.id).order_by(User.id)]
+
+    accepted, requests = friend_graph(args.users, args.friends, args.pending)
+    db.session.execute(insert(Friendship), [{'sender_id': ids[a], 'receiver_id': ids[b], 'status': 'accepted'} for a, b in accepted]
+                       + [{'sender_id': ids[a], 'receiver_id': ids[b], 'status': 'pending'} for a, b in requests])
+
+    # Snowflake ids laid out over SEED_SPAN_MS so that they sort before anything the server sends
+    total = len(accepted) * args.messages
+    start_ms = int(time.time() * 1000) - SEED_SPAN_MS
+    shift = SnowflakeIds.WORKER_BITS + SnowflakeIds.SEQUENCE_BITS
+    rows, k = [], 0
+    slots = list(range(total))
+    rng.shuffle(slots)  # interleave conversations in time
+    for a, b in accepted:
+        for _ in range(args.messages):
+            slot = slots[k]
+            k += 1
+            ms = start_ms + slot * SEED_SPAN_MS // max(1, total)
+            sender, receiver = (a, b) if rng.random() < 0.5 else (b, a)
+            rows.append({
+                'id': ((ms - SnowflakeIds.EPOCH_MS) << shift) | (SEED_WORKER_ID << SnowflakeIds.SEQUENCE_BITS) | (slot & 0xFFF),
+                'sender_id': ids[sender], 'receiver_id': ids[receiver],
+                'content': 'bench ' + 'x' * rng.randint(10, 120),
+                'timestamp': datetime.fromtimestamp(ms / 1000, timezone.utc).replace(tzinfo=None),
+            })
+            if len(rows) >= SEED_CHUNK:
+                db.session.execute(insert(Message), rows)
+                update_conversations(rows)
+                rows = []
+    if rows:
+        db.session.execute(insert(Message), rows)
+        update_conversations(rows)
+    db.session.commit()
+    return ids, accepted, requests
+
+
+# --- Benchmarks ---
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='chat-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    db_path = os.path.join(workdir, 'chat.db')
+    if os.path.exists(db_path): sys.exit(f"{db_path} already exists; the benchmark needs a fresh database")
+    os.environ['CHAT_DB'] = db_path  # read when models is imported
+
+    import MainServer
+    from flask_jwt_extended import create_access_token
+    from models import app, db
+    from password_hasher import _hash_password
+
+    rng = random.Random(args.seed)
+    print(f"Seeding {db_path}: {args.users} users, {args.friends} friends and {args.pending} requests each, "
+          f"{args.messages} messages per conversation")
+    start = time.perf_counter()
+    with app.app_context():
+        ids, accepted, requests = seed(args, rng, db, _hash_password(PASSWORD, app.config['BCRYPT_LOG_ROUNDS']))
+        tokens = {uid: create_access_token(identity=str(uid)) for uid in ids}
+    seed_s = time.perf_counter() - start
+
+    app.config['BAN_WATCH_ENABLED'] = False
+    MainServer.start_background_services()
+    http = app.test_client()
+
+    def auth(uid): return {'Authorization': f'Bearer {tokens[uid]}'}
+    def pair():
+        a, b = rng.choice(accepted)
+        return (ids[a], ids[b]) if rng.random() < 0.5 else (ids[b], ids[a])
+
+    registered = [0]
+    def register():
+        registered[0] += 1
+        name = f'newuser{registered[0]:06d}'
+        expect(http.post('/register', json={'username': name, 'password': PASSWORD, 'email': f'{name}@bench.local',
+                                            'display_name': f'New User {registered[0]}'}), 201)
+
+    def login(): expect(http.post('/login', json={'username': f'bench{rng.randrange(args.users):06d}', 'password': PASSWORD}), 200)
+    def search_users():  # 4 digits: the trigram (substring) path
+        expect(http.get('/search_users', query_string={'q': f'{rng.randrange(args.users):06d}'[2:]}, headers=auth(rng.choice(ids))), 200)
+    def search_users_prefix():  # < 3 characters: the prefix path
+        expect(http.get('/search_users', query_string={'q': f'{rng.randrange(100):02d}'}, headers=auth(rng.choice(ids))), 200)
+    def get_friends(): expect(http.get('/friends', headers=auth(rng.choice(ids))), 200)
+    def get_pending_requests(): expect(http.get('/pending_requests', headers=auth(rng.choice(ids))), 200)
+    def get_conversations(): expect(http.get('/conversations', headers=auth(rng.choice(ids))), 200)
+    def get_chat_history():
+        me, other = pair()
+        expect(http.get(f'/chat_history/{other}', headers=auth(me)), 200)
+
+    # Senders stay connected for the whole benchmark, like real clients
+    sockets = {}
+    def handle_send_message():
+        me, other = pair()
+        client = sockets.get(me)
+        if client is None:
+            client = sockets[me] = MainServer.socketio.test_client(app, auth={'token': tokens[me]})
+            if not client.is_connected(): raise RuntimeError(f"user {me} could not connect")
+        client.emit('send_message', {'to_user_id': other, 'content': 'bench send'})
+        client.get_received()  # the echo; keeps the test client's queue from growing
+
+    devices = [0]
+    def reconnect_drain():  # a device that has seen nothing: the whole seeded backlog, batch by batch
+        devices[0] += 1
+        client = MainServer.socketio.test_client(app, auth={'token': tokens[rng.choice(ids)], 'device': f'bench{devices[0]}', 'delivered': 0})
+        if not client.is_connected(): raise RuntimeError("could not connect")
+        while True:
+            batch = next((r['args'][0] for r in client.get_received() if r['name'] == 'message_batch'), None)
+            if batch is None: raise RuntimeError("no message_batch")
+            client.emit('ack', {'cursor': batch['cursor']})
+            if not batch['has_more']: break
+        client.disconnect()
+
+    benchmarks = [
+        ('register', register, args.auth_iterations),
+        ('login', login, args.auth_iterations),
+        ('search_users', search_users, args.iterations),
+        ('search_users_prefix', search_users_prefix, args.iterations),
+        ('get_friends', get_friends, args.iterations),
+        ('get_pending_requests', get_pending_requests, args.iterations),
+        ('get_chat_history', get_chat_history, args.iterations),
+        ('get_conversations', get_conversations, args.iterations),
+        ('handle_send_message', handle_send_message, args.iterations),
+        ('reconnect_drain', reconnect_drain, args.iterations),
+    ]
+    only = set(args.only.split(',')) if args.only else None
+    results = {}
+    for name, fn, iterations in benchmarks:
+        if only and name not in only: continue
+        results[name] = measure(fn, iterations, min(args.warmup, iterations))
+        print(f"  {name:<22} p50 {results[name]['p50_ms']:>9.3f} ms  p95 {results[name]['p95_ms']:>9.3f} ms")
+
+    for client in sockets.values(): client.disconnect()
+    MainServer.message_writer.flush()
+    MainServer.message_writer.stop()
+    if not args.workdir: shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'seed_s': round(seed_s, 2),
+            'scale': {'users': args.users, 'friends': args.friends, 'pending': args.pending, 'messages': args.messages,
+                      'friendships': len(accepted), 'requests': len(requests), 'total_messages': len(accepted) * args.messages},
+            'seed': args.seed, 'bcrypt_rounds': app.config['BCRYPT_LOG_ROUNDS'],
+            'message_durability': app.config['MESSAGE_DURABILITY'], 'async_mode': MainServer.ASYNC_MODE,
+            'metrics': app.config['METRICS_ENABLED'],
+        },
+        'results': results,
+    }
+
+
+# --- Compare ---
+
+def compare(baseline, current, metric, threshold):
+    """Print a table of current vs baseline; returns the names that regressed beyond threshold."""
+    if baseline['meta'].get('scale') != current['meta'].get('scale'):
+        print("warning: baseline was seeded at a different scale; numbers are not comparable")
+    regressions = []
+    print(f"{'benchmark':<22} {'baseline':>10} {'current':>10} {'change':>8}   ({metric})")
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if not base:
+            print(f"{name:<22} {'-':>10} {result[metric]:>10.3f} {'new':>8}")
+            continue
+        change = result[metric] / base[metric] - 1 if base[metric] else 0.0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif change < -threshold:
+            flag = '  improved'
+        print(f"{name:<22} {base[metric]:>10.3f} {result[metric]:>10.3f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    if args.load:
+        with open(args.load) as f: current = json.load(f)
+    else:
+        current = run(args)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f: f.write(json.dumps(current, indent=2, sort_keys=True) + '\n')
+        print(f"Saved results to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f: baseline = json.load(f)
+        regressions = compare(baseline, current, args.metric, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+    elif not args.save:
+        print(json.dumps(current, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chat_client import ChatClient, API_URL, HISTORY_PAGE_SIZE
+from chat_codec import ENCODING_JSON, ENCODING_MSGPACK, unpack_message
+
+# --- Load generator / soak test ---
+# Drives a running MainServer (+ grpc_server) with N synthetic users built on ChatClient:
+# register, login, friend graph, one socket per user, then sends and /chat_history
+# fetches at fixed rates. Prints (or writes) a JSON report that is meant to be diffed
+# between releases: latency percentiles per operation, throughput and error rates.
+# Run: python benchmarks/loadgen.py --users 50 --duration 60 --send-rate 1 --out report.json
+
+PASSWORD = 'loadgen-password'
+PERCENTILES = (50, 95, 99)
+
+
+class Recorder:
+    """Latency samples and error counts per operation, shared by all worker threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.elapsed = {}  # operation -> wall-clock seconds of the phase that ran it
+
+    def ok(self, op, seconds):
+        with self._lock: self.samples.setdefault(op, []).append(seconds)
+
+    def fail(self, op, count=1):
+        with self._lock: self.errors[op] = self.errors.get(op, 0) + count
+
+    def timed(self, op, fn, *args):
+        # fn returns something truthy on success
+        start = time.perf_counter()
+        try: result = fn(*args)
+        except Exception: result = None
+        if result: self.ok(op, time.perf_counter() - start)
+        else: self.fail(op)
+        return result
+
+    def report(self):
+        ops = {}
+        for op in sorted(set(self.samples) | set(self.errors)):
+            samples = sorted(self.samples.get(op, []))
+            errors = self.errors.get(op, 0)
+            total = len(samples) + errors
+            entry = {'count': len(samples), 'errors': errors,
+                     'error_rate': round(errors / total, 4) if total else 0.0}
+            if samples:
+                for p in PERCENTILES: entry[f'p{p}_ms'] = round(percentile(samples, p) * 1000, 2)
+                entry['max_ms'] = round(samples[-1] * 1000, 2)
+            if self.elapsed.get(op):
+                entry['throughput_per_s'] = round(len(samples) / self.elapsed[op], 2)
+            ops[op] = entry
+        return ops
+
+
+def percentile(sorted_samples, p):
+    # nearest-rank
+    k = max(0, min(len(sorted_samples) - 1, int(round(p / 100 * len(sorted_samples) + 0.5)) - 1))
+    return sorted_samples[k]
+
+
+def run_phase(recorder, ops, pool, fn, items):
+    start = time.perf_counter()
+    results = list(pool.map(fn, items))
+    for op in ops: recorder.elapsed[op] = time.perf_counter() - start
+    return results
+
+
+# --- Setup: users, friend graph, sockets ---
+
+def register(args, recorder, name):
+    client = ChatClient(encoding=args.encoding, api_url=args.url, use_cache=False)
+    payload = {'username': name, 'password': PASSWORD, 'email': f'{name}@loadgen.local',
+               'display_name': name}
+    recorder.timed('register', lambda: client.register(payload)[0])
+    client.close()
+
+
+def login(args, recorder, name):
+    client = ChatClient(encoding=args.encoding, api_url=args.url, use_cache=False)
+    if recorder.timed('login', lambda: client.login(name, PASSWORD)[0]): return client
+    client.close()
+    return None
+
+
+def friend_pairs(n, degree):
+    # Ring lattice: user i befriends the next `degree` users, so everyone has 2*degree friends
+    return sorted({tuple(sorted((i, (i + d) % n))) for i in range(n) for d in range(1, min(degree, n - 1) + 1)})
+
+
+def befriend(recorder, clients, pair):
+    a, b = clients[pair[0]], clients[pair[1]]
+    if recorder.timed('friend_request', lambda: a.send_friend_request(b.user_id)[0]):
+        recorder.timed('friend_response', b.respond_friend_request, a.user_id, 'accept')
+
+
+class Swarm:
+    """Socket side of the run: connect admission and send->receive delivery."""
+
+    def __init__(self, recorder, run_id):
+        self.recorder = recorder
+        self.run_id = run_id
+        self._lock = threading.Lock()
+        self.in_flight = {}  # content token -> perf_counter at send
+        self._seq = 0
+
+    def attach(self, client):
+        # Replaces ChatClient's own handlers: nothing is queued for a UI here
+        client.session_ready = threading.Event()
+
+        def on_session(data):
+            client.on_session(data)
+            client.session_ready.set()
+
+        def on_new_message(data):
+            received = time.perf_counter()
+            if isinstance(data, bytes): data = unpack_message(data)
+            if data.get('receiver_id') != client.user_id: return  # the sender's own echo
+            with self._lock: sent = self.in_flight.pop(data.get('content'), None)
+            if sent is not None: self.recorder.ok('delivery', received - sent)
+
+        client.sio.on('session', on_session)
+        client.sio.on('new_message', on_new_message)
+        client.sio.on('error', lambda data: self.recorder.fail('server_error'))
+
+    def connect(self, client, timeout):
+        start = time.perf_counter()
+        client.connect_websocket()
+        if client.sio.connected and client.session_ready.wait(timeout):
+            self.recorder.ok('connect', time.perf_counter() - start)
+            return True
+        self.recorder.fail('connect')
+        return False
+
+    def send(self, client, to_user_id):
+        with self._lock:
+            self._seq += 1
+            token = f'lg:{self.run_id}:{self._seq}'
+            self.in_flight[token] = time.perf_counter()
+        start = time.perf_counter()
+        try:
+            client.send_message(to_user_id, token)  # time to hand the packet to the socket
+            self.recorder.ok('send', time.perf_counter() - start)
+        except Exception:
+            with self._lock: self.in_flight.pop(token, None)
+            self.recorder.fail('send')
+
+    def lost(self):
+        with self._lock:
+            lost, self.in_flight = len(self.in_flight), {}
+        return lost
+
+
+# --- Steady state ---
+
+def fetch_history(recorder, client, peer_id):
+    def call():
+        resp = client.http_get(f"/chat_history/{peer_id}", params={'limit': HISTORY_PAGE_SIZE})
+        return resp is not None and resp.status_code == 200
+    recorder.timed('chat_history', call)
+
+
+def drive(args, recorder, swarm, client, friends, stop):
+    # One thread per user: sends and history fetches at fixed average rates, jittered
+    # so the swarm does not fire in lockstep
+    rng = random.Random(client.user_id)
+    now = time.perf_counter()
+    next_send = now + (rng.expovariate(args.send_rate) if args.send_rate else float('inf'))
+    next_history = now + (rng.expovariate(args.history_rate) if args.history_rate else float('inf'))
+    while not stop.is_set():
+        now = time.perf_counter()
+        if now >= next_send:
+            swarm.send(client, rng.choice(friends))
+            next_send += rng.expovariate(args.send_rate)
+        if now >= next_history:
+            fetch_history(recorder, client, rng.choice(friends))
+            next_history += rng.expovariate(args.history_rate)
+        stop.wait(max(0.0, min(next_send, next_history) - time.perf_counter()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default=API_URL)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--degree', type=int, default=3, help='friends on each side in the ring graph')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of steady-state traffic')
+    parser.add_argument('--send-rate', type=float, default=1.0, help='messages per second per user')
+    parser.add_argument('--history-rate', type=float, default=0.2, help='/chat_history fetches per second per user')
+    parser.add_argument('--encoding', choices=(ENCODING_JSON, ENCODING_MSGPACK), default=ENCODING_MSGPACK)
+    parser.add_argument('--concurrency', type=int, default=16, help='parallel HTTP calls during setup')
+    parser.add_argument('--connect-timeout', type=float, default=10)
+    parser.add_argument('--drain', type=float, default=5, help='seconds to wait for in-flight messages')
+    parser.add_argument('--out', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:8]
+    names = [f'lg_{run_id}_{i}' for i in range(args.users)]
+    recorder = Recorder()
+    swarm = Swarm(recorder, run_id)
+    started_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        run_phase(recorder, ['register'], pool, lambda n: register(args, recorder, n), names)
+        clients = run_phase(recorder, ['login'], pool, lambda n: login(args, recorder, n), names)
+        clients = [c for c in clients if c]
+        pairs = friend_pairs(len(clients), args.degree)
+        run_phase(recorder, ['friend_request', 'friend_response'], pool,
+                  lambda p: befriend(recorder, clients, p), pairs)
+        for c in clients: swarm.attach(c)
+        connected = run_phase(recorder, ['connect'], pool,
+                              lambda c: swarm.connect(c, args.connect_timeout), clients)
+
+    friends = {c.user_id: [] for c in clients}
+    for i, j in pairs:
+        friends[clients[i].user_id].append(clients[j].user_id)
+        friends[clients[j].user_id].append(clients[i].user_id)
+    active = [c for c, ok in zip(clients, connected) if ok and friends[c.user_id]]
+
+    stop = threading.Event()
+    workers = [threading.Thread(target=drive, args=(args, recorder, swarm, c, friends[c.user_id], stop), daemon=True)
+               for c in active]
+    start = time.perf_counter()
+    for w in workers: w.start()
+    time.sleep(args.duration)
+    stop.set()
+    for w in workers: w.join()
+    steady = time.perf_counter() - start
+    time.sleep(args.drain)
+    recorder.fail('delivery', swarm.lost())
+    for op in ('send', 'delivery', 'chat_history', 'server_error'): recorder.elapsed[op] = steady
+
+    for c in clients: c.close()
+
+    report = {
+        'started_at': started_at,
+        'config': {k: v for k, v in vars(args).items() if k != 'out'},
+        'users': {'registered': len(recorder.samples.get('register', [])), 'logged_in': len(clients),
+                  'connected': sum(connected), 'friendships': len(pairs)},
+        'steady_state_s': round(steady, 2),
+        'operations': recorder.report(),
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f: f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
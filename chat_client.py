@@ -0,0 +1,471 @@
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import socketio
+from requests.adapters import HTTPAdapter
+
+from chat_codec import ENCODING_JSON, ENCODING_MSGPACK, negotiate, unpack_message, unpack_batch, pack_send
+
+# --- Chat client (no UI) ---
+# HTTP + Socket.IO client used by client_gui.py and by headless tools such as
+# benchmarks/loadgen.py. Events are delivered through message_queue; a UI sets
+# `notify` to be woken when something is queued.
+
+# --- Configuration ---
+API_URL = "http://127.0.0.1:8000"
+HISTORY_PAGE_SIZE = 50  # messages per chat_history page
+HTTP_WORKERS = 4  # concurrent API calls (and pooled keep-alive connections)
+HTTP_TIMEOUT = 10
+MESSAGE_ENCODING = ENCODING_MSGPACK  # compact chat events if msgpack is installed; falls back to JSON
+ACK_DELAY = 1.0  # seconds; live messages are acked once per window, not one by one
+
+# --- Backend Logic ---
+class ChatClient:
+    def __init__(self, encoding=MESSAGE_ENCODING, api_url=API_URL, use_cache=True):
+        self.api_url = api_url
+        self.use_cache = use_cache  # headless clients skip the on-disk message cache
+        self.sio = socketio.Client()
+        self.requested_encoding = negotiate(encoding)
+        self.encoding = ENCODING_JSON  # confirmed by the server's 'session' event
+        self.token = None
+        self.user_id = None
+        self.username = None
+        self.my_avatar_hash = None
+        self.message_queue = queue.Queue()
+        self.notify = None  # set by the UI: wakes its event loop, called from socket/sync threads
+        self._wakeup = threading.Event()  # a wake-up is pending; one per batch, not per event
+        self.cache = None  # MessageCache of the logged-in account
+        self.profiles = ProfileStore()
+        self.live = False  # synced since the last connect, so socket messages move the watermark
+        self.server_push = False  # server sends the offline backlog as 'message_batch' and takes acks
+        self._ack_lock = threading.Lock()
+        self._ack_upto = 0  # newest message id received, acked by the pending timer
+        self._ack_timer = None
+        self._ack_ready = False  # namespace connected: the first batch is pushed before the handshake ends
+        self._ack_held = None  # ack for a batch that arrived before that
+
+        # Keep-alive connections shared by all calls; UI calls go through call_async
+        self.http = requests.Session()
+        self.http.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_WORKERS))
+        self.http.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_WORKERS))
+        self.executor = ThreadPoolExecutor(HTTP_WORKERS, thread_name_prefix="http")
+        self._inflight = {}  # key -> token of the newest call_async with that key (UI thread only)
+        
+        self.sio.on('connect', self.on_connect)
+        self.sio.on('disconnect', self.on_disconnect)
+        self.sio.on('session', self.on_session)
+        self.sio.on('new_message', self.on_new_message)
+        self.sio.on('message_batch', self.on_message_batch)
+        self.sio.on('new_friend_request', self.on_friend_request)
+        for event in ('friend_accepted', 'friend_rejected', 'friend_removed', 'profile_changed'):
+            self.sio.on(event, lambda data, event=event: self.on_friend_event(event, data))
+        self.sio.on('conversation_read', lambda data: self.post('conversation_read', data))  # read on another device
+        self.sio.on('error', self.on_server_error)
+
+    def http_post(self, endpoint, data):
+        headers = {'Authorization': f'Bearer {self.token}'} if self.token else {}
+        try: return self.http.post(f"{self.api_url}{endpoint}", json=data, headers=headers, timeout=HTTP_TIMEOUT)
+        except: return None
+
+    def http_get(self, endpoint, params=None):
+        headers = {'Authorization': f'Bearer {self.token}'} if self.token else {}
+        try: return self.http.get(f"{self.api_url}{endpoint}", headers=headers, params=params, timeout=HTTP_TIMEOUT)
+        except: return None
+
+    def call_async(self, calls, callback, key=None):
+        """Run calls (no-arg callables) concurrently on the HTTP pool and, once all are done,
+        run callback(*results) on the UI thread. Must be called from the UI thread.
+
+        A newer call with the same key supersedes this one: its queued calls are cancelled
+        and its callback is dropped, so only the latest chat/search/sidebar result lands.
+        """
+        token = object()
+        if key is not None:
+            old = self._inflight.get(key)
+            if old:
+                for f in old[1]: f.cancel()
+        futures = [self.executor.submit(fn) for fn in calls]
+        if key is not None: self._inflight[key] = (token, futures)
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]: return
+            if any(f.cancelled() for f in futures): return
+            results = []
+            for f in futures:
+                try: results.append(f.result())
+                except Exception as e:
+                    print(f"[HTTP] Background call failed: {e}")
+                    results.append(None)
+            self.post('callback', (key, token, callback, results))
+        for f in futures: f.add_done_callback(done)
+        return futures
+
+    def deliver(self, item):
+        # UI thread: run a call_async callback unless a newer call with its key replaced it
+        key, token, callback, results = item
+        if key is not None:
+            current = self._inflight.get(key)
+            if not current or current[0] is not token: return
+            del self._inflight[key]
+        callback(*results)
+
+    def login(self, username, password):
+        resp = self.http_post("/login", {"username": username, "password": password})
+        if resp and resp.status_code == 200:
+            data = resp.json()
+            self.token = data['access_token']
+            self.user_id = int(data['user_id'])
+            self.username = data['display_name']
+            self.my_avatar_hash = data.get('avatar_hash')
+            self.open_cache()
+            return True, data
+        return False, resp.json().get('error') if resp else "Connection Error"
+
+    def register(self, payload):
+        resp = self.http_post("/register", payload)
+        return resp.status_code == 201 if resp else False, resp.json() if resp else {}
+
+    def get_friends(self):
+        resp = self.http_get("/friends")
+        return self.profiles.put_many(resp.json()) if resp and resp.status_code == 200 else []
+
+    def search_users(self, query):
+        resp = self.http_get("/search_users", params={'q': query})
+        return self.profiles.put_many(resp.json()) if resp and resp.status_code == 200 else []
+
+    def send_friend_request(self, receiver_id):
+        resp = self.http_post("/friend_request", {'receiver_id': receiver_id})
+        return resp.status_code == 201 if resp else False, resp.json() if resp else {}
+
+    def get_pending_requests(self):
+        resp = self.http_get("/pending_requests")
+        return self.profiles.put_many(resp.json()) if resp and resp.status_code == 200 else []
+
+    def respond_friend_request(self, sender_id, action):
+        resp = self.http_post("/friend_response", {'sender_id': sender_id, 'action': action})
+        return resp.status_code == 200 if resp else False
+
+    def remove_friend(self, friend_id):
+        resp = self.http_post("/friend_remove", {'friend_id': friend_id})
+        return resp.status_code == 200 if resp else False
+
+    def update_profile(self, changes):
+        resp = self.http_post("/profile", changes)
+        if resp and resp.status_code == 200:
+            self.profiles.put_many([resp.json()])
+            return True, resp.json()
+        return False, resp.json() if resp else {}
+
+    def get_avatar(self, avatar_hash, size):
+        # PNG bytes; b'' if the server has no such avatar, None if it could not be reached
+        try: resp = self.http.get(f"{self.api_url}/avatars/{avatar_hash}/{size}", timeout=HTTP_TIMEOUT)
+        except requests.RequestException: return None
+        return resp.content if resp.status_code == 200 else b''
+
+    def get_conversations(self, limit=None):
+        # Inbox, most recent first: [{'user', 'last_message', 'unread'}]
+        resp = self.http_get("/conversations", params={'limit': limit} if limit else None)
+        if not resp or resp.status_code != 200: return []
+        convs = resp.json()
+        self.profiles.put_many([c['user'] for c in convs])
+        return convs
+
+    def mark_read(self, peer_id, last_read_id=None):
+        resp = self.http_post(f"/conversations/{peer_id}/read", {'last_read_id': last_read_id} if last_read_id else {})
+        return resp.json()['unread'] if resp and resp.status_code == 200 else None
+
+    def get_chat_history(self, other_user_id, before_id=None, after_id=None, limit=None):
+        params = {k: v for k, v in (('before_id', before_id), ('after_id', after_id), ('limit', limit)) if v is not None}
+        resp = self.http_get(f"/chat_history/{other_user_id}", params=params)
+        return resp.json() if resp and resp.status_code == 200 else None
+
+    def open_cache(self):
+        if not self.use_cache: return
+        os.makedirs(MESSAGE_CACHE_DIR, exist_ok=True)
+        self.cache = MessageCache(os.path.join(MESSAGE_CACHE_DIR, f"{self.user_id}.db"), self.user_id)
+        if self.cache.watermark() is None:
+            # New cache: start syncing from the server's head; older history is paged in per chat
+            resp = self.http_get("/messages")
+            if resp and resp.status_code == 200: self.cache.start_at(resp.json()['cursor'])
+
+    def sync_messages(self):
+        # Delta since the watermark (minus a small overlap for late commits); new ones are queued for the UI
+        watermark = self.cache.watermark()
+        if watermark is None: return
+        since_id = max(0, watermark - SYNC_OVERLAP_IDS) if watermark >> 22 else watermark  # pre-snowflake ids: no overlap
+        while True:
+            resp = self.http_get("/messages", params={'since_id': since_id, 'limit': SYNC_PAGE_SIZE})
+            if not resp or resp.status_code != 200: return
+            data = resp.json()
+            for m in self.cache.add(data['messages']): self.post('new_message', m)
+            since_id = data['cursor']
+            self.cache.advance(since_id)
+            if not data['has_more']: break
+        self.live = self.sio.connected
+
+    def load_history(self, peer_id, before_id=None, limit=HISTORY_PAGE_SIZE):
+        """Messages with peer_id older than before_id (newest page if None), oldest first.
+
+        Served from the local cache; only the part the cache does not hold yet is fetched.
+        None if that fetch failed, so the caller does not take it for the start of the chat.
+        """
+        synced_from = self.cache.synced_from(peer_id) if self.cache else None
+        if synced_from is None:  # no cache, or server was unreachable when it was opened
+            return self.get_chat_history(peer_id, before_id=before_id, limit=limit)
+        msgs = self.cache.history(peer_id, before_id, limit, min_id=synced_from)
+        if len(msgs) < limit and synced_from:
+            need = limit - len(msgs)
+            boundary = min(synced_from, before_id) if before_id else synced_from
+            older = self.get_chat_history(peer_id, before_id=boundary, limit=need)
+            if older is None: return msgs if before_id is None else None  # offline: open with what is cached
+            self.cache.add(older)
+            self.cache.extend_back(peer_id, older[0]['id'] if len(older) == need else 0)
+            msgs = older + msgs
+        return msgs
+
+    def send_message(self, to_user_id, content):
+        if self.encoding == ENCODING_MSGPACK:
+            self.sio.emit('send_message', pack_send(to_user_id, content))
+        else:
+            self.sio.emit('send_message', {'to_user_id': to_user_id, 'content': content})
+
+    def connect_websocket(self):
+        auth = {'token': self.token, 'encoding': self.requested_encoding}
+        if self.cache:  # the server's backlog for this device starts after what is cached
+            auth.update(device=self.cache.device_id(), delivered=self.cache.watermark())
+        try:
+            self.sio.connect(self.api_url, auth=auth)
+            threading.Thread(target=self.sio.wait, daemon=True).start()
+        except: pass
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        try: self.sio.disconnect()
+        except: pass
+
+    def ack(self, cursor):
+        with self._ack_lock:
+            if not self._ack_ready:
+                self._ack_held = max(self._ack_held or 0, cursor)
+                return
+        try: self.sio.emit('ack', {'cursor': cursor})
+        except Exception: pass  # disconnected: the backlog is pushed again on reconnect
+
+    def ack_later(self, message_id):
+        # Cumulative: one ack per ACK_DELAY covers every live message received in it
+        with self._ack_lock:
+            self._ack_upto = max(self._ack_upto, message_id)
+            if not self.live or self._ack_timer: return  # still draining: the last batch ack covers it
+            self._ack_timer = threading.Timer(ACK_DELAY, self._flush_ack)
+            self._ack_timer.daemon = True
+            self._ack_timer.start()
+
+    def _flush_ack(self):
+        with self._ack_lock:
+            self._ack_timer = None
+            cursor = self._ack_upto
+        self.ack(cursor)
+
+    def on_connect(self):
+        with self._ack_lock:
+            self._ack_ready = True
+            held, self._ack_held = self._ack_held, None
+        if held: self.ack(held)
+        self.post('status', 'connected')
+    def on_disconnect(self):
+        self.live = False
+        with self._ack_lock: self._ack_ready = False
+        self.post('status', 'disconnected')
+    def on_session(self, data):
+        self.encoding = data.get('encoding', ENCODING_JSON)
+        self.server_push = bool(data.get('drain'))
+        if self.cache and not self.server_push:  # older server: pull the delta over HTTP
+            threading.Thread(target=self.sync_messages, daemon=True).start()
+    def on_message_batch(self, data):
+        # Offline backlog, oldest first; acking a batch makes the server send the next one
+        if isinstance(data, bytes): data = unpack_batch(data)
+        messages = self.cache.add(data['messages']) if self.cache else data['messages']
+        for m in messages: self.post('new_message', m)
+        cursor = data['cursor']
+        if self.cache: self.cache.advance(cursor)
+        if not data['has_more']:
+            with self._ack_lock:
+                self.live = True
+                cursor = max(cursor, self._ack_upto)  # live messages that came in while draining
+        self.ack(cursor)
+    def on_new_message(self, data):
+        if isinstance(data, bytes): data = unpack_message(data)
+        if self.server_push: self.ack_later(data['id'])
+        if self.cache:
+            if not self.cache.add([data]): return  # already delivered by a sync
+            if self.live: self.cache.advance(data['id'])
+        self.post('new_message', data)
+    def on_server_error(self, data):
+        # With message_id: a message this account sent was not saved after all
+        if self.cache and data.get('message_id'): self.cache.remove(data['message_id'])
+        self.post('error', data)
+    def on_friend_request(self, data):
+        if data.get('user'): self.profiles.put_many([data['user']])
+        self.post('new_request', data)
+
+    def on_friend_event(self, event, data):
+        # friend_accepted / profile_changed carry the other user's profile
+        if data.get('user'): self.profiles.put_many([data['user']])
+        elif data.get('user_id'): self.profiles.invalidate(data['user_id'])
+        self.post(event, data)
+
+    def post(self, kind, data):
+        self.message_queue.put((kind, data))
+        if self.notify and not self._wakeup.is_set():
+            self._wakeup.set()
+            try: self.notify()
+            except Exception: self._wakeup.clear()  # UI not running yet/anymore
+
+    def drain(self):
+        """Everything queued so far, for the UI thread. Clears the wake-up first so an event
+        posted while draining schedules a new one."""
+        self._wakeup.clear()
+        events = []
+        while True:
+            try: events.append(self.message_queue.get_nowait())
+            except queue.Empty: return events
+
+# --- Profile Store ---
+# id -> public profile (username, display_name, avatar_hash) for every user the client has
+# seen in /friends, /pending_requests, search results or socket events. Entries expire
+# after PROFILE_TTL so renamed users and new avatars show up without a restart.
+PROFILE_TTL = 300
+PROFILE_STORE_SIZE = 5000
+PROFILE_FIELDS = ('id', 'username', 'display_name', 'avatar_hash', 'avatar_url')
+
+class ProfileStore:
+    def __init__(self, ttl=PROFILE_TTL, max_size=PROFILE_STORE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.items = OrderedDict()  # id -> (profile, stored_at)
+        self._lock = threading.Lock()
+
+    def put_many(self, users):
+        now = time.monotonic()
+        with self._lock:
+            for u in users:
+                self.items[u['id']] = ({k: u.get(k) for k in PROFILE_FIELDS}, now)
+                self.items.move_to_end(u['id'])
+            while len(self.items) > self.max_size: self.items.popitem(last=False)
+        return users
+
+    def get(self, user_id):
+        with self._lock:
+            item = self.items.get(user_id)
+            if item is None: return None
+            profile, stored_at = item
+            if time.monotonic() - stored_at > self.ttl:
+                del self.items[user_id]
+                return None
+            self.items.move_to_end(user_id)
+            return profile
+
+    def invalidate(self, user_id):
+        with self._lock: self.items.pop(user_id, None)
+
+# --- Local Message Cache ---
+# Per-account SQLite copy of the chat history. The watermark is the sync cursor: on every
+# (re)connect /messages?since_id=<watermark> brings in everything newer, across all chats.
+# Each conversation also records synced_from: the cache holds all of its messages from
+# that id up to the watermark (0 = the whole conversation), so reopening a chat costs no
+# request and scrolling back only fetches what is older than that.
+MESSAGE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".messenger_lite")
+SYNC_PAGE_SIZE = 500
+MAX_MESSAGE_ID = (1 << 63) - 1
+SYNC_OVERLAP_IDS = 5000 << 22  # ~5 s of snowflake ids: messages committed slightly out of order
+
+class MessageCache:
+    def __init__(self, path, user_id):
+        self.user_id = user_id
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._execute("PRAGMA journal_mode=WAL")
+        self._execute("""CREATE TABLE IF NOT EXISTS message (
+            id INTEGER PRIMARY KEY, peer_id INTEGER NOT NULL, sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL, content TEXT NOT NULL, timestamp TEXT)""")
+        self._execute("CREATE INDEX IF NOT EXISTS ix_message_peer ON message (peer_id, id)")
+        self._execute("""CREATE TABLE IF NOT EXISTS conversation (
+            peer_id INTEGER PRIMARY KEY, synced_from INTEGER NOT NULL, last_seen_id INTEGER NOT NULL)""")
+        self._execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _state(self, key):
+        rows = self._execute("SELECT value FROM sync_state WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def watermark(self): return self._state('watermark')
+
+    def device_id(self):
+        # Random per cache file, so each install of an account has its own delivered watermark
+        self._execute("INSERT OR IGNORE INTO sync_state VALUES ('device', ?)", (random.getrandbits(62),))
+        return str(self._state('device'))
+
+    def start_at(self, cursor):
+        # Everything after `cursor` will arrive through sync, for every conversation
+        self._execute("INSERT OR REPLACE INTO sync_state VALUES ('base', ?)", (cursor,))
+        self._execute("INSERT OR REPLACE INTO sync_state VALUES ('watermark', ?)", (cursor,))
+
+    def advance(self, cursor):
+        self._execute("UPDATE sync_state SET value = MAX(value, ?) WHERE key = 'watermark'", (cursor,))
+
+    def add(self, messages):
+        """Store messages; return the ones that were not cached yet."""
+        new = []
+        with self._lock:
+            self._db.execute("BEGIN")
+            for m in messages:
+                peer_id = m['receiver_id'] if m['sender_id'] == self.user_id else m['sender_id']
+                cur = self._db.execute("INSERT OR IGNORE INTO message VALUES (?, ?, ?, ?, ?, ?)",
+                                       (m['id'], peer_id, m['sender_id'], m['receiver_id'], m['content'], m['timestamp']))
+                if not cur.rowcount: continue
+                new.append(m)
+                self._db.execute("""INSERT INTO conversation VALUES (?, COALESCE((SELECT value + 1 FROM sync_state WHERE key = 'base'), ?), ?)
+                    ON CONFLICT (peer_id) DO UPDATE SET last_seen_id = MAX(last_seen_id, excluded.last_seen_id)""",
+                                 (peer_id, m['id'], m['id']))
+            self._db.execute("COMMIT")
+        return new
+
+    def remove(self, message_id):
+        self._execute("DELETE FROM message WHERE id = ?", (message_id,))
+
+    def synced_from(self, peer_id):
+        rows = self._execute("SELECT synced_from FROM conversation WHERE peer_id = ?", (peer_id,))
+        if rows: return rows[0][0]
+        base = self._state('base')
+        return base + 1 if base is not None else None
+
+    def extend_back(self, peer_id, synced_from):
+        self._execute("""INSERT INTO conversation VALUES (?, ?, 0)
+            ON CONFLICT (peer_id) DO UPDATE SET synced_from = MIN(synced_from, excluded.synced_from)""",
+                      (peer_id, synced_from))
+
+    def last_seen_id(self, peer_id):
+        rows = self._execute("SELECT last_seen_id FROM conversation WHERE peer_id = ?", (peer_id,))
+        return rows[0][0] if rows else None
+
+    def history(self, peer_id, before_id=None, limit=HISTORY_PAGE_SIZE, min_id=0):
+        # Stray messages below synced_from (sync overlap) are skipped: that range is not complete
+        rows = self._execute("""SELECT id, sender_id, receiver_id, content, timestamp FROM message
+            WHERE peer_id = ? AND id >= ? AND id < ? ORDER BY id DESC LIMIT ?""",
+                             (peer_id, min_id, before_id if before_id is not None else MAX_MESSAGE_ID, limit))
+        return [{'id': r[0], 'sender_id': r[1], 'receiver_id': r[2], 'content': r[3], 'timestamp': r[4]}
+                for r in reversed(rows)]
@@ -0,0 +1,94 @@
+from datetime import datetime, timezone
+
+try:
+    import msgpack
+except ImportError:  # compact encoding is optional on both ends
+    msgpack = None
+
+# --- Chat event encodings ---
+# 'json' is the default Socket.IO payload. 'msgpack' is opt-in: chat events travel as one
+# binary attachment holding a msgpack map with one-letter tags and epoch-ms timestamps.
+# The client asks for an encoding in its connect auth and the server answers with the
+# one it picked in a 'session' event.
+
+ENCODING_JSON = 'json'
+ENCODING_MSGPACK = 'msgpack'
+
+MESSAGE_TAGS = {'id': 'i', 'sender_id': 's', 'receiver_id': 'r', 'content': 'c', 'timestamp': 't'}
+SEND_TAGS = {'to_user_id': 'r', 'content': 'c'}
+BATCH_TAGS = {'messages': 'm', 'cursor': 'k', 'has_more': 'h'}
+
+
+def supported_encodings():
+    return (ENCODING_JSON, ENCODING_MSGPACK) if msgpack else (ENCODING_JSON,)
+
+
+def negotiate(requested, enabled=True):
+    if enabled and requested in supported_encodings(): return requested
+    return ENCODING_JSON
+
+
+def to_epoch_ms(dt):
+    # Message timestamps are naive UTC
+    return int(dt.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def from_epoch_ms(ms):
+    return datetime.fromtimestamp(ms / 1000, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+def _tag(fields, tags):
+    return {tags[k]: v for k, v in fields.items()}
+
+
+def _untag(tagged, tags):
+    return {k: tagged.get(t) for k, t in tags.items()}
+
+
+def _pack(fields, tags):
+    return msgpack.packb(_tag(fields, tags), use_bin_type=True)
+
+
+def _unpack(data, tags):
+    return _untag(msgpack.unpackb(data, raw=False), tags)
+
+
+def _message_fields(m):
+    return {'id': m.id, 'sender_id': m.sender_id, 'receiver_id': m.receiver_id,
+            'content': m.content, 'timestamp': to_epoch_ms(m.timestamp)}
+
+
+def _message_dict(tagged):
+    msg = _untag(tagged, MESSAGE_TAGS)
+    msg['timestamp'] = from_epoch_ms(msg['timestamp'])
+    return msg
+
+
+def pack_message(m):
+    """Message -> compact bytes."""
+    return _pack(_message_fields(m), MESSAGE_TAGS)
+
+
+def unpack_message(data):
+    """Compact bytes -> the same dict the JSON 'new_message' event carries."""
+    return _message_dict(msgpack.unpackb(data, raw=False))
+
+
+def pack_batch(messages, cursor, has_more):
+    """'message_batch' payload -> compact bytes: one map, messages tagged like pack_message."""
+    return _pack({'messages': [_tag(_message_fields(m), MESSAGE_TAGS) for m in messages],
+                  'cursor': cursor, 'has_more': has_more}, BATCH_TAGS)
+
+
+def unpack_batch(data):
+    batch = _unpack(data, BATCH_TAGS)
+    batch['messages'] = [_message_dict(m) for m in batch['messages']]
+    return batch
+
+
+def pack_send(to_user_id, content):
+    return _pack({'to_user_id': to_user_id, 'content': content}, SEND_TAGS)
+
+
+def unpack_send(data):
+    return _unpack(data, SEND_TAGS)
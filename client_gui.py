@@ -1,18 +1,17 @@
 import customtkinter as ctk
 import tkinter as tk
 from tkinter import messagebox, filedialog
-import requests
-import socketio
-import threading
-import queue
 from datetime import datetime
 import random
+import bisect
+from collections import OrderedDict
+from functools import lru_cache
 import base64
-from PIL import Image, ImageTk
+from PIL import Image, ImageTk, ImageDraw, ImageFont
 import io
+from chat_client import ChatClient, HISTORY_PAGE_SIZE
 
 # --- Configuration & Theme ---
-API_URL = "http://127.0.0.1:8000"
 ctk.set_appearance_mode("Light")
 ctk.set_default_color_theme("blue")
 
@@ -23,165 +22,383 @@ COLOR_TEXT_ME = "#FFFFFF"
 COLOR_TEXT_YOU = "#000000"
 COLOR_ACCENT = "#5B96F7"
 
-# --- Backend Logic ---
-class ChatClient:
-    def __init__(self):
-        self.sio = socketio.Client()
-        self.token = None
-        self.user_id = None
-        self.username = None
-        self.my_avatar_data = None
-        self.message_queue = queue.Queue()
-        
-        self.sio.on('connect', self.on_connect)
-        self.sio.on('disconnect', self.on_disconnect)
-        self.sio.on('new_message', self.on_new_message)
-        self.sio.on('new_friend_request', self.on_friend_request)
-
-    def http_post(self, endpoint, data):
-        headers = {'Authorization': f'Bearer {self.token}'} if self.token else {}
-        try: return requests.post(f"{API_URL}{endpoint}", json=data, headers=headers)
-        except: return None
-
-    def http_get(self, endpoint, params=None):
-        headers = {'Authorization': f'Bearer {self.token}'} if self.token else {}
-        try: return requests.get(f"{API_URL}{endpoint}", headers=headers, params=params)
-        except: return None
-
-    def login(self, username, password):
-        resp = self.http_post("/login", {"username": username, "password": password})
-        if resp and resp.status_code == 200:
-            data = resp.json()
-            self.token = data['access_token']
-            self.user_id = int(data['user_id'])
-            self.username = data['display_name']
-            self.my_avatar_data = data.get('avatar')
-            return True, data
-        return False, resp.json().get('error') if resp else "Connection Error"
-
-    def register(self, payload):
-        resp = self.http_post("/register", payload)
-        return resp.status_code == 201 if resp else False, resp.json() if resp else {}
-
-    def get_friends(self):
-        resp = self.http_get("/friends")
-        return resp.json() if resp and resp.status_code == 200 else []
-
-    def search_users(self, query):
-        resp = self.http_get("/search_users", params={'q': query})
-        return resp.json() if resp and resp.status_code == 200 else []
-
-    def send_friend_request(self, receiver_id):
-        resp = self.http_post("/friend_request", {'receiver_id': receiver_id})
-        return resp.status_code == 201 if resp else False, resp.json() if resp else {}
-
-    def get_pending_requests(self):
-        resp = self.http_get("/pending_requests")
-        return resp.json() if resp and resp.status_code == 200 else []
-
-    def respond_friend_request(self, sender_id, action):
-        resp = self.http_post("/friend_response", {'sender_id': sender_id, 'action': action})
-        return resp.status_code == 200 if resp else False
-
-    def get_chat_history(self, other_user_id):
-        resp = self.http_get(f"/chat_history/{other_user_id}")
-        return resp.json() if resp and resp.status_code == 200 else []
-
-    def send_message(self, to_user_id, content):
-        self.sio.emit('send_message', {'to_user_id': to_user_id, 'content': content})
-
-    def connect_websocket(self):
-        try:
-            self.sio.connect(API_URL, auth={'token': self.token})
-            threading.Thread(target=self.sio.wait, daemon=True).start()
-        except: pass
-
-    def close(self):
-        try: self.sio.disconnect()
-        except: pass
-
-    def on_connect(self): self.message_queue.put(('status', 'connected'))
-    def on_disconnect(self): self.message_queue.put(('status', 'disconnected'))
-    def on_new_message(self, data): self.message_queue.put(('new_message', data))
-    def on_friend_request(self, data): self.message_queue.put(('new_request', data))
+# --- Avatar Cache ---
+# Avatars are content-addressed on the server (/avatars/<hash>/<size>), so a decoded
+# image for (hash, size) never changes. Decoded CTkImages, and the initials fallback
+# per (name, size), are kept in one process-wide LRU bounded by an estimate of their
+# pixel memory. An avatar not cached yet shows the initials and is fetched on the
+# client's HTTP pool; the image is decoded and swapped in from the Tk loop.
+AVATAR_CACHE_MAX_BYTES = 16 * 1024 * 1024
+AVATAR_FETCH_SLOTS = 2  # of the client's HTTP workers; the others stay free for chat/search/sidebar calls
+AVATAR_COLORS = ["#FF5733", "#33FF57", "#3357FF", "#F033FF", "#FF33A8"]
+
+class AvatarCache:
+    def __init__(self, max_bytes=AVATAR_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.items = OrderedDict()  # key -> (CTkImage or None, cost)
+        self.initial_colors = {}
+        self.client = None  # ChatClient that fetches avatars; set by ChatApp
+        self.loading = {}  # key -> widgets waiting for the image
+        self.queued = []  # (key, avatar_hash, size) waiting for a fetch slot, newest last
+        self.in_flight = 0
+
+    def get(self, name, avatar_hash, size, waiter=None):
+        """Image to show now. If the avatar has to be fetched first, waiter.set_image(image)
+        is called later on the Tk thread, unless the waiter was destroyed by then."""
+        if avatar_hash:
+            found, image = self._lookup(('hash', avatar_hash, size))
+            if image: return image
+            if not found and waiter: self._fetch(avatar_hash, size, waiter)
+        return self._initials(name, size)
+
+    def _lookup(self, key):
+        item = self.items.get(key)
+        if item is None: return False, None
+        self.items.move_to_end(key)
+        return True, item[0]
+
+    def _store(self, key, image, size):
+        cost = size * size * 4 * 2 if image else 64  # RGBA pixels + Tk PhotoImage copy
+        self.items[key] = (image, cost)
+        self.used_bytes += cost
+        while self.used_bytes > self.max_bytes and len(self.items) > 1:
+            _, (_, old_cost) = self.items.popitem(last=False)
+            self.used_bytes -= old_cost
+        return image
+
+    def _fetch(self, avatar_hash, size, waiter):
+        key = ('hash', avatar_hash, size)
+        if key in self.loading:
+            self.loading[key].append(waiter)
+            return
+        if not self.client: return
+        self.loading[key] = [waiter]
+        self.queued.append((key, avatar_hash, size))
+        self._start_fetches()
+
+    def _start_fetches(self):
+        # Newest first: the rows just rendered. Rows destroyed by a later sidebar/search
+        # render drop out before they cost a request.
+        while self.in_flight < AVATAR_FETCH_SLOTS and self.queued:
+            key, avatar_hash, size = self.queued.pop()
+            if not any(w.winfo_exists() for w in self.loading[key]):
+                del self.loading[key]
+                continue
+            self.in_flight += 1
+            self.client.call_async([lambda h=avatar_hash, s=size: self.client.get_avatar(h, s)],
+                                   lambda data, key=key, size=size: self._loaded(key, data, size))
+
+    def _loaded(self, key, data, size):
+        self.in_flight -= 1
+        waiters = self.loading.pop(key, [])
+        if data is not None:  # None = unreachable: not cached, retried on the next render
+            image = None
+            if data:
+                try: image = ctk.CTkImage(light_image=Image.open(io.BytesIO(data)), size=(size, size))
+                except: pass
+            self._store(key, image, size)
+            if image:
+                for w in waiters:
+                    if w.winfo_exists(): w.set_image(image)
+        self._start_fetches()
+
+    def _initials(self, name, size):
+        key = ('initials', name, size)
+        found, image = self._lookup(key)
+        if found: return image
+        if name not in self.initial_colors: self.initial_colors[name] = random.choice(AVATAR_COLORS)
+        pil_img = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(pil_img)
+        draw.ellipse((2, 2, size-2, size-2), fill=self.initial_colors[name])
+        initial = name[0].upper() if name else "?"
+        draw.text((size/2, size/2), initial, fill="white", font=initials_font(int(size/2.5)), anchor="mm")
+        return self._store(key, ctk.CTkImage(light_image=pil_img, size=(size, size)), size)
+
+@lru_cache(maxsize=None)
+def initials_font(px):
+    for face in ("arialbd.ttf", "Arial Bold.ttf", "DejaVuSans-Bold.ttf"):
+        try: return ImageFont.truetype(face, px)
+        except OSError: pass
+    return ImageFont.load_default(px)
+
+avatar_cache = AvatarCache()
 
 # --- UI Components ---
 class Avatar(ctk.CTkFrame):
-    def __init__(self, master, name, avatar_data=None, size=40, **kwargs):
+    def __init__(self, master, name, avatar_hash=None, size=40, **kwargs):
         super().__init__(master, width=size, height=size, fg_color="transparent", **kwargs)
-        image = None
-        if avatar_data:
-            try:
-                img_bytes = base64.b64decode(avatar_data)
-                pil_img = Image.open(io.BytesIO(img_bytes))
-                pil_img = pil_img.resize((size, size), Image.Resampling.LANCZOS)
-                image = ctk.CTkImage(light_image=pil_img, size=(size, size))
-            except: pass
-
-        if image:
-            self.lbl = ctk.CTkLabel(self, text="", image=image)
-            self.lbl.place(relx=0.5, rely=0.5, anchor="center")
-        else:
-            canvas = ctk.CTkCanvas(self, width=size, height=size, bg=COLOR_BG_SIDEBAR, highlightthickness=0)
-            canvas.place(relx=0.5, rely=0.5, anchor="center")
-            colors = ["#FF5733", "#33FF57", "#3357FF", "#F033FF", "#FF33A8"]
-            fill_col = random.choice(colors)
-            initial = name[0].upper() if name else "?"
-            canvas.create_oval(2, 2, size-2, size-2, fill=fill_col, outline="")
-            canvas.create_text(size/2, size/2, text=initial, fill="white", font=("Arial", int(size/2.5), "bold"))
-            self.lbl = canvas
+        self.lbl = ctk.CTkLabel(self, text="", image=avatar_cache.get(name, avatar_hash, size, self))
+        self.lbl.place(relx=0.5, rely=0.5, anchor="center")
+
+    def set_image(self, image):
+        self.lbl.configure(image=image)
 
     def bind_click(self, command):
         self.lbl.bind("<Button-1>", command)
 
 class FriendListItem(ctk.CTkFrame):
-    def __init__(self, master, user_id, username, avatar_data, on_click, **kwargs):
+    def __init__(self, master, user_id, username, avatar_hash, on_click, on_remove=None, preview=None, unread=0, **kwargs):
         super().__init__(master, fg_color="transparent", corner_radius=0, height=60, **kwargs)
         self.user_id = user_id
         self.on_click = on_click
+        self.on_remove = on_remove
         self.username = username
 
         self.bind("<Enter>", lambda e: self.configure(fg_color="#E8E8E8"))
         self.bind("<Leave>", lambda e: self.configure(fg_color="transparent"))
         self.bind("<Button-1>", self.clicked)
 
-        self.avatar = Avatar(self, username, avatar_data, size=40)
+        self.avatar = Avatar(self, username, avatar_hash, size=40)
         self.avatar.place(x=10, y=10)
         self.avatar.bind_click(self.clicked)
 
         self.lbl_name = ctk.CTkLabel(self, text=username, font=("Arial", 14, "bold"), text_color="black")
-        self.lbl_name.place(x=60, y=15)
+        self.lbl_name.place(x=60, y=6 if preview else 15)
         self.lbl_name.bind("<Button-1>", self.clicked)
+        clickable = [self, self.lbl_name, self.avatar.lbl]
+        if preview:
+            self.lbl_preview = ctk.CTkLabel(self, text=preview if len(preview) <= 30 else preview[:29] + "…",
+                                            font=("Arial", 11, "bold" if unread else "normal"), text_color="black" if unread else "gray")
+            self.lbl_preview.place(x=60, y=30)
+            self.lbl_preview.bind("<Button-1>", self.clicked)
+            clickable.append(self.lbl_preview)
+        if unread:
+            badge = ctk.CTkLabel(self, text=str(unread) if unread < 100 else "99+", width=22, height=22, corner_radius=11,
+                                 fg_color=COLOR_ACCENT, text_color="white", font=("Arial", 10, "bold"))
+            badge.place(relx=1.0, x=-15, y=19, anchor="ne")
+            badge.bind("<Button-1>", self.clicked)
+        if on_remove:
+            for w in clickable: w.bind("<Button-3>", self.remove_clicked)
 
     def clicked(self, event=None):
         self.on_click(self.user_id, self.username)
 
+    def remove_clicked(self, event=None):
+        if messagebox.askyesno("Remove friend", f"Remove {self.username} from your friends?"):
+            self.on_remove(self.user_id)
+
 class ChatBubble(ctk.CTkFrame):
-    def __init__(self, master, text, is_me, timestamp, **kwargs):
+    def __init__(self, master, text="", is_me=False, timestamp=None, **kwargs):
         super().__init__(master, fg_color="transparent", **kwargs)
-        bg = COLOR_BUBBLE_ME if is_me else COLOR_BUBBLE_YOU
-        fg = COLOR_TEXT_ME if is_me else COLOR_TEXT_YOU
-        anchor = "e" if is_me else "w"
-        
         self.container = ctk.CTkFrame(self, fg_color="transparent")
         self.container.pack(fill="x", padx=20, pady=5)
-        self.bubble = ctk.CTkFrame(self.container, fg_color=bg, corner_radius=18)
-        self.bubble.pack(anchor=anchor, ipadx=5, ipady=2)
-        self.lbl = ctk.CTkLabel(self.bubble, text=text, text_color=fg, font=("Arial", 13), wraplength=400, justify="left")
+        self.bubble = ctk.CTkFrame(self.container, corner_radius=18)
+        self.bubble.pack(ipadx=5, ipady=2)
+        self.lbl = ctk.CTkLabel(self.bubble, font=("Arial", 13), wraplength=400, justify="left")
         self.lbl.pack(padx=12, pady=8)
-        
+        self.time = ctk.CTkLabel(self.bubble, font=("Arial", 8))
+        self.time.pack(anchor="e", padx=10, pady=(0,5))
+        self.set(text, is_me, timestamp)
+
+    def set(self, text, is_me, timestamp):
+        # Bubbles are recycled by MessageList, so everything message-specific is set here
+        fg = COLOR_TEXT_ME if is_me else COLOR_TEXT_YOU
+        self.bubble.configure(fg_color=COLOR_BUBBLE_ME if is_me else COLOR_BUBBLE_YOU)
+        self.bubble.pack_configure(anchor="e" if is_me else "w")
+        self.lbl.configure(text=text, text_color=fg)
         try:
             dt = datetime.fromisoformat(timestamp)
             time_str = dt.strftime("%H:%M")
         except: time_str = ""
-        self.time = ctk.CTkLabel(self.bubble, text=time_str, text_color=fg, font=("Arial", 8))
-        self.time.pack(anchor="e", padx=10, pady=(0,5))
+        self.time.configure(text=time_str, text_color=fg)
+
+class MessageList(ctk.CTkFrame):
+    """Virtualized chat view.
+
+    Only messages in the viewport (plus a margin) have widgets: a pool of ChatBubbles is
+    recycled over them and placed on a canvas at offsets computed from their heights,
+    measured the first time a message is shown and estimated before that. Scrolling near
+    the top asks load_older(before_id) for the previous page.
+    """
+    MARGIN = 400  # px rendered beyond the viewport on each side
+    GAP = 10  # px between bubbles
+    LOAD_OLDER_PX = 300  # distance from the top that triggers load_older
+    CHARS_PER_LINE = 55  # ~400 px wraplength at Arial 13
+
+    def __init__(self, master, my_id, load_older, **kwargs):
+        super().__init__(master, fg_color="white", **kwargs)
+        self.my_id = my_id
+        self.load_older = load_older
+        self.canvas = tk.Canvas(self, bg="white", highlightthickness=0, yscrollincrement=20)
+        self.scrollbar = ctk.CTkScrollbar(self, command=self.canvas.yview)
+        self.scrollbar.pack(side="right", fill="y")
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.canvas.configure(yscrollcommand=self._on_view)
+        self.canvas.bind("<Configure>", self._on_resize)
+        for seq in ("<MouseWheel>", "<Button-4>", "<Button-5>"): self.bind_all(seq, self._on_wheel, add="+")
+
+        self.pool = []  # free (bubble, canvas window) pairs
+        self.bound = {}  # message index -> (bubble, canvas window)
+        self.follow = True  # keep the newest message in view
+        self._render_job = None
+        self.generation = 0
+        self.clear()
+
+    # --- Data ---
+    def clear(self):
+        self.generation += 1  # invalidates pending load_older calls
+        for i in list(self.bound): self._release(i)
+        self.messages, self.heights, self.offsets = [], [], [0]
+        self.ids = set()
+        self.exhausted = False
+        self.loading = False
+        self._update_region()
+
+    def set_messages(self, messages, exhausted):
+        self.clear()
+        self.exhausted = exhausted
+        for m in messages: self._add(m)
+        self._recompute_offsets()
+        self._update_region()
+        self.scroll_to_bottom()
+
+    def append(self, m):
+        self.extend([m])
+
+    def extend(self, messages):
+        added = [self._add(m) for m in sorted(messages, key=lambda m: m['id'])]
+        if not any(added): return
+        self._recompute_offsets()
+        self._update_region()
+        if self.follow: self.scroll_to_bottom()
+        else: self._schedule_render()
+
+    def prepend(self, messages, exhausted):
+        # Older page: shift everything down and move the view by the same amount so the
+        # messages on screen stay put
+        self.loading = False
+        self.exhausted = exhausted
+        older = [m for m in messages if m['id'] not in self.ids]
+        if not older: return
+        top = self.canvas.canvasy(0)
+        self.ids.update(m['id'] for m in older)
+        self.messages[:0] = older
+        self.heights[:0] = [self._estimate(m) for m in older]
+        self.bound = {i + len(older): item for i, item in self.bound.items()}
+        self._recompute_offsets()
+        self._place_bound()
+        self._update_region()
+        self._move_to(top + self.offsets[len(older)])
+
+    def _add(self, m):
+        if m['id'] in self.ids: return False
+        self.ids.add(m['id'])
+        self.messages.append(m)
+        self.heights.append(self._estimate(m))
+        return True
+
+    def _estimate(self, m):
+        lines = sum(max(1, -(-len(line) // self.CHARS_PER_LINE)) for line in m['content'].split("\n"))
+        return 50 + 17 * lines + self.GAP
+
+    def _recompute_offsets(self):
+        offsets = [0]
+        for h in self.heights: offsets.append(offsets[-1] + h)
+        self.offsets = offsets
+
+    # --- View ---
+    def scroll_to_bottom(self):
+        self.follow = True
+        self.canvas.yview_moveto(1.0)
+        self._schedule_render()
+
+    def _move_to(self, y):
+        self.canvas.yview_moveto(y / max(self._region_height(), 1))
+
+    def _region_height(self):
+        return max(self.offsets[-1], self.canvas.winfo_height())
+
+    def _update_region(self):
+        self.canvas.configure(scrollregion=(0, 0, self.canvas.winfo_width(), self._region_height()))
+
+    def _on_view(self, first, last):
+        self.scrollbar.set(first, last)
+        self.follow = float(last) >= 0.999
+        self._schedule_render()
+
+    def _on_resize(self, event):
+        for bubble, win in list(self.bound.values()) + self.pool: self.canvas.itemconfigure(win, width=event.width)
+        self._update_region()
+        if self.follow: self.canvas.yview_moveto(1.0)
+        self._schedule_render()
+
+    def _on_wheel(self, event):
+        if not str(event.widget).startswith(str(self.canvas)): return
+        if event.num == 4: step = -3
+        elif event.num == 5: step = 3
+        else: step = -int(event.delta / 120) * 3 if abs(event.delta) >= 120 else -event.delta
+        self.canvas.yview_scroll(step, "units")
+
+    def _schedule_render(self):
+        # Coalesce: scroll, resize and new messages in the same frame render once
+        if self._render_job is None: self._render_job = self.after_idle(self._render)
+
+    def _render(self):
+        self._render_job = None
+        n = len(self.messages)
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        lo = max(0, bisect.bisect_right(self.offsets, top - self.MARGIN) - 1)
+        hi = min(n, bisect.bisect_left(self.offsets, bottom + self.MARGIN))
+
+        for i in [i for i in self.bound if not lo <= i < hi]: self._release(i)
+        new = [i for i in range(lo, hi) if i not in self.bound]
+        for i in new: self._bind(i)
+        if new:
+            self.canvas.update_idletasks()
+            changed = False
+            for i in new:
+                h = self.bound[i][0].winfo_reqheight() + self.GAP
+                if h != self.heights[i]: self.heights[i], changed = h, True
+            if changed: self._relayout(top)
+
+        if n and top < self.LOAD_OLDER_PX and not self.exhausted and not self.loading:
+            self.loading = True
+            self.after_idle(self._load_older, self.generation, self.messages[0]['id'])
+
+    def _load_older(self, generation, before_id):
+        if generation == self.generation: self.load_older(before_id)  # else the chat was switched
+
+    def _relayout(self, top):
+        # Heights changed: keep the message at the top of the viewport where it was
+        anchor = max(0, bisect.bisect_right(self.offsets, top) - 1)
+        shift = top - self.offsets[anchor]
+        self._recompute_offsets()
+        self._place_bound()
+        self._update_region()
+        if self.follow: self.canvas.yview_moveto(1.0)
+        else: self._move_to(self.offsets[anchor] + shift)
+
+    def _place_bound(self):
+        for i, (_, win) in self.bound.items(): self.canvas.coords(win, 0, self.offsets[i])
+
+    def _bind(self, i):
+        if self.pool:
+            bubble, win = self.pool.pop()
+            self.canvas.itemconfigure(win, state="normal")
+        else:
+            bubble = ChatBubble(self.canvas)
+            win = self.canvas.create_window(0, 0, window=bubble, anchor="nw", width=self.canvas.winfo_width())
+        m = self.messages[i]
+        bubble.set(m['content'], int(m['sender_id']) == int(self.my_id), m['timestamp'])
+        self.canvas.coords(win, 0, self.offsets[i])
+        self.bound[i] = (bubble, win)
+
+    def _release(self, i):
+        bubble, win = self.bound.pop(i)
+        self.canvas.itemconfigure(win, state="hidden")
+        self.pool.append((bubble, win))
 
 # --- Main Application ---
+CLIENT_EVENT = "<<ClientEvent>>"  # virtual event the socket thread uses to wake the Tk loop
+SIDEBAR_REFRESH_DEBOUNCE_MS = 300
+
 class ChatApp(ctk.CTk):
     def __init__(self, client_logic):
         super().__init__()
         self.client = client_logic
+        avatar_cache.client = self.client
         self.title(f"Messenger - {self.client.username}")
         self.geometry("1100x700")
         self.configure(fg_color="white")
@@ -197,7 +414,7 @@ class ChatApp(ctk.CTk):
 
         self.side_header = ctk.CTkFrame(self.sidebar, fg_color="transparent", height=60)
         self.side_header.pack(fill="x", pady=10, padx=10)
-        self.my_avatar = Avatar(self.side_header, self.client.username, self.client.my_avatar_data, size=40)
+        self.my_avatar = Avatar(self.side_header, self.client.username, self.client.my_avatar_hash, size=40)
         self.my_avatar.pack(side="left")
         ctk.CTkLabel(self.side_header, text="Chats", font=("Arial", 20, "bold"), text_color="gray").pack(side="right", padx=10)
 
@@ -236,8 +453,8 @@ class ChatApp(ctk.CTk):
         self.header_name = ctk.CTkLabel(self.chat_header, text="", font=("Arial", 18, "bold"), text_color="black")
         self.header_name.pack(side="left", pady=10)
 
-        self.msg_scroll = ctk.CTkScrollableFrame(self.main_chat, fg_color="white")
-        self.msg_scroll.pack(fill="both", expand=True)
+        self.msg_view = MessageList(self.main_chat, self.client.user_id, self.load_older)
+        self.msg_view.pack(fill="both", expand=True)
 
         self.input_bar = ctk.CTkFrame(self.main_chat, fg_color="white", height=60)
         self.input_bar.pack(fill="x", side="bottom", padx=20, pady=10)
@@ -249,7 +466,15 @@ class ChatApp(ctk.CTk):
         self.current_pid = None
         self.mode = "friends"
         self.refresh_sidebar()
-        self.process_queue()
+        self._sidebar_job = None
+        self.friends = {}  # id -> profile, Friends tab
+        self.conversations = {}  # peer id -> {'last_message', 'unread'}; friends with recent chats sort first
+        self.requests = {}  # id -> profile, incoming friend requests
+        self.sidebar_rows = {}  # row key -> (widget, data it was built from, pack options)
+        self.sidebar_order = []
+        self.bind(CLIENT_EVENT, self.process_queue)
+        self.client.notify = lambda: self.event_generate(CLIENT_EVENT, when="tail")
+        self.after(0, self.process_queue)  # anything queued before the window existed
         self.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def show_friends(self):
@@ -268,13 +493,16 @@ class ChatApp(ctk.CTk):
         if self.mode == "friends": return
         q = self.search_entry.get()
         if not q: return
-        for w in self.list_scroll.winfo_children(): w.destroy()
-        res = self.client.search_users(q)
+        self.client.call_async([lambda: self.client.search_users(q)], self.show_search_results, key='sidebar')
+
+    def show_search_results(self, res):
+        if self.mode != "search": return
+        self.clear_sidebar()
         if not res: ctk.CTkLabel(self.list_scroll, text="No users found", text_color="gray").pack(pady=20)
         for u in res:
             f = ctk.CTkFrame(self.list_scroll, fg_color="white", height=50)
             f.pack(fill="x", pady=1)
-            Avatar(f, u['display_name'], u['avatar'], size=35).pack(side="left", padx=10)
+            Avatar(f, u['display_name'], u['avatar_hash'], size=35).pack(side="left", padx=10)
             ctk.CTkLabel(f, text=u['display_name'], font=("Arial", 13, "bold"), text_color="black").pack(side="left")
             
             st = u['status']
@@ -285,49 +513,134 @@ class ChatApp(ctk.CTk):
 
     def refresh_sidebar(self):
         if self.mode == "search": return
+        # All lists are fetched in parallel and rendered together
+        self.client.call_async([self.client.get_pending_requests, self.client.get_friends, self.client.get_conversations],
+                               self.show_sidebar, key='sidebar')
+
+    def show_sidebar(self, reqs, friends, convs=None):
+        self.requests = {u['id']: u for u in reqs or []}
+        self.friends = {u['id']: u for u in friends or []}
+        self.conversations = {c['user']['id']: {'last_message': c['last_message'], 'unread': c['unread']} for c in convs or []}
+        self.render_sidebar()
+
+    def clear_sidebar(self):
         for w in self.list_scroll.winfo_children(): w.destroy()
-        
-        reqs = self.client.get_pending_requests()
-        if reqs:
-            ctk.CTkLabel(self.list_scroll, text="REQUESTS", text_color=COLOR_ACCENT, font=("Arial", 10, "bold")).pack(anchor="w", padx=15, pady=5)
-            for r in reqs:
-                f = ctk.CTkFrame(self.list_scroll, fg_color="white")
-                f.pack(fill="x", pady=1)
-                Avatar(f, r['display_name'], r['avatar'], size=30).pack(side="left", padx=5)
-                ctk.CTkLabel(f, text=r['display_name'], text_color="black").pack(side="left")
-                ctk.CTkButton(f, text="✓", width=30, fg_color="green", command=lambda i=r['id']: self.resp(i, 'accept')).pack(side="right", padx=2)
-                ctk.CTkButton(f, text="✗", width=30, fg_color="red", command=lambda i=r['id']: self.resp(i, 'reject')).pack(side="right", padx=5)
-
-        friends = self.client.get_friends()
-        if not friends: ctk.CTkLabel(self.list_scroll, text="No friends yet", text_color="gray").pack(pady=20)
-        for f in friends:
-            FriendListItem(self.list_scroll, f['id'], f['display_name'], f['avatar'], self.open_chat).pack(fill="x", pady=1)
+        self.sidebar_rows, self.sidebar_order = {}, []
+
+    def render_sidebar(self):
+        # Keyed diff against the rows on screen: only added/changed rows are built and removed
+        # ones destroyed; existing widgets are just re-packed when something moved
+        if self.mode == "search": return
+        by_name = lambda u: (u['display_name'].lower(), u['id'])
+        by_recency = lambda u: (-self.conversations.get(u['id'], {'last_message': {'id': 0}})['last_message']['id'],) + by_name(u)
+        desired = []
+        if self.requests: desired.append((('label', 'requests'), None))
+        desired += [(('request', u['id']), (u['display_name'], u['avatar_hash'])) for u in sorted(self.requests.values(), key=by_name)]
+        if not self.friends: desired.append((('label', 'no_friends'), None))
+        desired += [(('friend', u['id']), (u['display_name'], u['avatar_hash']) + self._conversation_summary(u['id']))
+                    for u in sorted(self.friends.values(), key=by_recency)]
+
+        wanted = dict(desired)
+        for key, (widget, data, _) in list(self.sidebar_rows.items()):
+            if key not in wanted or wanted[key] != data:
+                widget.destroy()
+                del self.sidebar_rows[key]
+        created = False
+        for key, data in desired:
+            if key not in self.sidebar_rows:
+                self.sidebar_rows[key] = self._new_sidebar_row(key, data)
+                created = True
+
+        order = [key for key, _ in desired]
+        if created or order != self.sidebar_order:
+            for key in self.sidebar_order:
+                if key in self.sidebar_rows: self.sidebar_rows[key][0].pack_forget()
+            for key in order:
+                widget, _, pack = self.sidebar_rows[key]
+                widget.pack(**pack)
+            self.sidebar_order = order
+
+    def _new_sidebar_row(self, key, data):
+        kind, ident = key
+        if kind == 'label' and ident == 'requests':
+            return (ctk.CTkLabel(self.list_scroll, text="REQUESTS", text_color=COLOR_ACCENT, font=("Arial", 10, "bold")),
+                    data, {'anchor': "w", 'padx': 15, 'pady': 5})
+        if kind == 'label':
+            return ctk.CTkLabel(self.list_scroll, text="No friends yet", text_color="gray"), data, {'pady': 20}
+        name, avatar_hash = data[:2]
+        if kind == 'request':
+            f = ctk.CTkFrame(self.list_scroll, fg_color="white")
+            Avatar(f, name, avatar_hash, size=30).pack(side="left", padx=5)
+            ctk.CTkLabel(f, text=name, text_color="black").pack(side="left")
+            ctk.CTkButton(f, text="✓", width=30, fg_color="green", command=lambda: self.resp(ident, 'accept')).pack(side="right", padx=2)
+            ctk.CTkButton(f, text="✗", width=30, fg_color="red", command=lambda: self.resp(ident, 'reject')).pack(side="right", padx=5)
+            return f, data, {'fill': "x", 'pady': 1}
+        preview, unread = data[2:]
+        item = FriendListItem(self.list_scroll, ident, name, avatar_hash, self.open_chat, on_remove=self.unfriend,
+                              preview=preview, unread=unread)
+        return item, data, {'fill': "x", 'pady': 1}
+
+    def _conversation_summary(self, uid):
+        conv = self.conversations.get(uid)
+        if not conv: return (None, 0)
+        last = conv['last_message']
+        prefix = "You: " if last['sender_id'] == self.client.user_id else ""
+        return (prefix + last['preview'], 0 if uid == self.current_pid else conv['unread'])
 
     def req(self, uid):
-        self.client.send_friend_request(uid)
-        self.on_search()
+        self.client.call_async([lambda: self.client.send_friend_request(uid)], lambda _: self.on_search())
     def resp(self, uid, act):
-        self.client.respond_friend_request(uid, act)
-        self.refresh_sidebar()
+        # The server also pushes friend_accepted/friend_rejected; applying it here too keeps the
+        # sidebar right if the socket is down
+        def done(ok):
+            if not ok: return
+            profile = self.requests.pop(uid, None)
+            if act == 'accept' and profile: self.friends[uid] = profile
+            self.render_sidebar()
+        self.client.call_async([lambda: self.client.respond_friend_request(uid, act)], done)
+    def unfriend(self, uid):
+        def done(ok):
+            if ok and self.friends.pop(uid, None): self.render_sidebar()
+        self.client.call_async([lambda: self.client.remove_friend(uid)], done)
 
     def open_chat(self, uid, uname):
         self.current_pid = uid
+        conv = self.conversations.get(uid)
+        if conv and conv['unread']:
+            conv['unread'] = 0
+            self.client.call_async([lambda: self.client.mark_read(uid, conv['last_message']['id'])], lambda _: None)
+            self.schedule_sidebar_render()  # not now: the clicked row is rebuilt
         self.welcome.place_forget()
         self.main_chat.pack(fill="both", expand=True)
+        self.show_chat_header(uid, uname)
+        self.msg_view.set_messages([], exhausted=True)
+        # Switching chats quickly supersedes the previous fetch (same key)
+        self.client.call_async([lambda: self.client.load_history(uid)], lambda msgs: self.show_chat(uid, msgs), key='chat')
+
+    def show_chat_header(self, uid, uname):
+        # From the profile store; only an expired/unknown profile costs a /friends refresh
+        profile = self.client.profiles.get(uid)
         for w in self.header_avt_frame.winfo_children(): w.destroy()
-        f_list = self.client.get_friends()
-        avt = None
-        for f in f_list:
-            if f['id'] == uid: avt = f['avatar']
-        
-        Avatar(self.header_avt_frame, uname, avt, size=45).pack()
-        self.header_name.configure(text=uname)
-        
-        for w in self.msg_scroll.winfo_children(): w.destroy()
-        self.msg_scroll.update()
-        msgs = self.client.get_chat_history(uid)
-        for m in msgs: self.add_bubble(m)
-        self.after(100, self.scroll_btm)
+        Avatar(self.header_avt_frame, profile['display_name'] if profile else uname,
+               profile['avatar_hash'] if profile else None, size=45).pack()
+        self.header_name.configure(text=profile['display_name'] if profile else uname)
+        if not profile:
+            self.client.call_async([self.client.get_friends],
+                                   lambda _: uid == self.current_pid and self.client.profiles.get(uid) and self.show_chat_header(uid, uname),
+                                   key='header')
+
+    def show_chat(self, uid, msgs):
+        if uid != self.current_pid: return
+        self.msg_view.set_messages(msgs or [], exhausted=len(msgs or []) < HISTORY_PAGE_SIZE)
+
+    def load_older(self, before_id):
+        uid = self.current_pid
+        if not uid: return
+        def done(msgs):
+            if uid != self.current_pid: return
+            if msgs is None: self.msg_view.loading = False  # server unreachable: retry on the next scroll
+            else: self.msg_view.prepend(msgs, exhausted=len(msgs) < HISTORY_PAGE_SIZE)
+        self.client.call_async([lambda: self.client.load_history(uid, before_id=before_id)], done, key='older')
 
     def send_msg(self, event=None):
         t = self.entry_msg.get()
@@ -335,26 +648,76 @@ class ChatApp(ctk.CTk):
             self.client.send_message(self.current_pid, t)
             self.entry_msg.delete(0, tk.END)
 
-    def add_bubble(self, m):
-        is_me = (int(m['sender_id']) == int(self.client.user_id))
-        ChatBubble(self.msg_scroll, m['content'], is_me, m['timestamp']).pack(fill="x", pady=5)
-        self.after(10, self.scroll_btm)
-
-    def scroll_btm(self): self.msg_scroll._parent_canvas.yview_moveto(1.0)
+    def process_queue(self, event=None):
+        # One pass per wake-up: the whole backlog is applied as a batch
+        incoming = []
+        for t, d in self.client.drain():
+            if t == 'new_message':
+                self.note_message(d)
+                if self.current_pid and (d['sender_id'] == self.current_pid or d['receiver_id'] == self.current_pid):
+                    incoming.append(d)
+            elif t == 'conversation_read':
+                if d['user_id'] in self.conversations: self.conversations[d['user_id']]['unread'] = d['unread']
+                self.schedule_sidebar_render()
+            elif t == 'callback':
+                self.client.deliver(d)
+            elif t == 'error':
+                messagebox.showwarning("Error", d.get('message', 'Server error'))
+            elif t in ('new_request', 'friend_accepted', 'friend_rejected', 'friend_removed', 'profile_changed'):
+                self.apply_friend_event(t, d)
+        if incoming:
+            self.msg_view.extend(incoming)
+            seen = [m['id'] for m in incoming if m['sender_id'] == self.current_pid]
+            if seen:
+                uid = self.current_pid
+                self.client.call_async([lambda: self.client.mark_read(uid, max(seen))], lambda _: None, key='read')
+
+    def note_message(self, m):
+        # Keep the local inbox in step with live messages (the server updates its copy on commit)
+        peer = m['receiver_id'] if m['sender_id'] == self.client.user_id else m['sender_id']
+        conv = self.conversations.setdefault(peer, {'last_message': {'id': 0}, 'unread': 0})
+        if m['id'] <= conv['last_message']['id']: return
+        conv['last_message'] = {'id': m['id'], 'sender_id': m['sender_id'], 'preview': m['content'][:100], 'timestamp': m['timestamp']}
+        if peer == m['sender_id'] and peer != self.current_pid: conv['unread'] += 1
+        self.schedule_sidebar_render()
+
+    def apply_friend_event(self, t, d):
+        user = d.get('user')
+        if t == 'new_request':
+            if not user: return self.schedule_sidebar_refresh()  # older server: no profile in the event
+            self.requests[user['id']] = user
+        elif t == 'friend_accepted' and user:
+            self.requests.pop(user['id'], None)
+            self.friends[user['id']] = user
+        elif t == 'friend_rejected':
+            self.requests.pop(d['user_id'], None)
+        elif t == 'friend_removed':
+            self.friends.pop(d['user_id'], None)
+        elif t == 'profile_changed' and user:
+            for group in (self.friends, self.requests):
+                if user['id'] in group: group[user['id']] = user
+            if user['id'] == self.current_pid: self.show_chat_header(user['id'], user['display_name'])
+        self.schedule_sidebar_render()
+
+    def schedule_sidebar_render(self):
+        # Debounced: a burst of friend events updates the sidebar once
+        if self._sidebar_job: self.after_cancel(self._sidebar_job)
+        self._sidebar_job = self.after(SIDEBAR_REFRESH_DEBOUNCE_MS, self._render_sidebar_now)
+
+    def _render_sidebar_now(self):
+        self._sidebar_job = None
+        self.render_sidebar()
+
+    def schedule_sidebar_refresh(self):
+        if self._sidebar_job: self.after_cancel(self._sidebar_job)
+        self._sidebar_job = self.after(SIDEBAR_REFRESH_DEBOUNCE_MS, self._refresh_sidebar_now)
+
+    def _refresh_sidebar_now(self):
+        self._sidebar_job = None
+        self.refresh_sidebar()
 
-    def process_queue(self):
-        try:
-            while not self.client.message_queue.empty():
-                t, d = self.client.message_queue.get_nowait()
-                if t == 'new_message':
-                    if self.current_pid and (d['sender_id'] == self.current_pid or d['receiver_id'] == self.current_pid):
-                        self.add_bubble(d)
-                elif t == 'new_request':
-                    if self.mode == "friends": self.refresh_sidebar()
-        except: pass
-        self.after(100, self.process_queue)
-    
     def on_close(self):
+        self.client.notify = None
         self.client.close()
         self.destroy()
 
@@ -1,8 +1,53 @@
-from models import app, db
+import base64
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+from models import app, db, User, Conversation, PREVIEW_LENGTH, install_search_index, search_key
+from avatar_store import AvatarStore, InvalidAvatar
 
 with app.app_context():
     print("Đang tạo các bảng database...")
     
     db.create_all()
+    # Khóa tìm kiếm (casefold trong Python) cho DB cũ; thay cho các index lower() trước đây
+    user_columns = {c['name'] for c in inspect(db.engine).get_columns('user')}
+    with db.engine.begin() as conn:
+        for column in ('username_key', 'display_name_key'):
+            if column not in user_columns: conn.execute(text(f'ALTER TABLE user ADD COLUMN {column} VARCHAR'))
+        conn.execute(text('DROP INDEX IF EXISTS ix_user_username_lower'))
+        conn.execute(text('DROP INDEX IF EXISTS ix_user_display_name_lower'))
+        rows = conn.execute(text('SELECT id, username, display_name FROM user WHERE username_key IS NULL OR display_name_key IS NULL')).all()
+        if rows:
+            conn.execute(text('UPDATE user SET username_key = :u, display_name_key = :d WHERE id = :id'),
+                         [{'id': r.id, 'u': search_key(r.username), 'd': search_key(r.display_name)} for r in rows])
+    # create_all() skips tables that already exist, so add any new indexes explicitly
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+    install_search_index()
+
+    # Chuyển avatar base64 cũ sang avatar store (content-addressed)
+    if 'avatar_hash' not in {c['name'] for c in inspect(db.engine).get_columns('user')}:
+        db.session.execute(text('ALTER TABLE user ADD COLUMN avatar_hash VARCHAR(64)'))
+        db.session.commit()
+    store = AvatarStore(app.config['AVATAR_STORE_DIR'])
+    for u in User.query.filter(User.avatar_base64.isnot(None), User.avatar_hash.is_(None)):
+        try:
+            u.avatar_hash = store.put(base64.b64decode(u.avatar_base64))
+            u.avatar_base64 = None
+        except (ValueError, InvalidAvatar) as e:
+            print(f"Bỏ qua avatar của user {u.id}: {e}")
+    db.session.commit()
+
+    # Tạo bảng tóm tắt hội thoại từ tin nhắn cũ (coi như đã đọc hết)
+    if not db.session.query(Conversation.user_a_id).first():
+        db.session.execute(text(f"""
+            INSERT INTO conversation (user_a_id, user_b_id, last_message_id, last_sender_id, last_preview,
+                                      last_timestamp, unread_a, unread_b, read_upto_a, read_upto_b)
+            SELECT l.a, l.b, m.id, m.sender_id, substr(m.content, 1, {PREVIEW_LENGTH}), m.timestamp, 0, 0, m.id, m.id
+            FROM (SELECT min(sender_id, receiver_id) AS a, max(sender_id, receiver_id) AS b, max(id) AS last_id
+                  FROM message GROUP BY a, b) AS l
+            JOIN message m ON m.id = l.last_id"""))
+        db.session.commit()
     
-    print("Đã tạo database 'chat.db' và các bảng thành công!")
\ No newline at end of file
+    print("Đã tạo database 'chat.db' và các bảng thành công!")
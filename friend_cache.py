@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict
+
+# --- Friend adjacency cache ---
+# Per-user friend / pending-request id sets, loaded with one query on a miss and
+# then updated in place by the friend request handlers. The TTL bounds staleness
+# when other MainServer workers change relationships this worker did not see.
+
+
+class Adjacency:
+    __slots__ = ('friends', 'incoming', 'outgoing', 'expires')
+
+    def __init__(self, ttl):
+        self.friends = set()
+        self.incoming = set()   # pending requests sent to this user
+        self.outgoing = set()   # pending requests sent by this user
+        self.expires = time.monotonic() + ttl
+
+
+class FriendAdjacencyCache:
+    def __init__(self, ttl=60.0, max_users=10000):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, user_id, load_edges):
+        """Return the Adjacency of a user; load_edges(user_id) -> [(sender_id, receiver_id, status)] on a miss."""
+        with self._lock:
+            adj = self._items.get(user_id)
+            if adj is not None and adj.expires > time.monotonic():
+                self._items.move_to_end(user_id)
+                return adj
+
+        adj = Adjacency(self.ttl)
+        for sender_id, receiver_id, status in load_edges(user_id):
+            other = receiver_id if sender_id == user_id else sender_id
+            if status == 'accepted': adj.friends.add(other)
+            elif sender_id == user_id: adj.outgoing.add(other)
+            else: adj.incoming.add(other)
+
+        with self._lock:
+            self._items[user_id] = adj
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_users:
+                self._items.popitem(last=False)
+        return adj
+
+    def friend_ids(self, user_id, load_edges):
+        adj = self.get(user_id, load_edges)
+        with self._lock: return set(adj.friends)
+
+    def incoming_ids(self, user_id, load_edges):
+        adj = self.get(user_id, load_edges)
+        with self._lock: return set(adj.incoming)
+
+    def related_ids(self, user_id, load_edges):
+        # Friends plus pending requests in either direction
+        adj = self.get(user_id, load_edges)
+        with self._lock: return adj.friends | adj.incoming | adj.outgoing
+
+    def _cached(self, user_id):
+        adj = self._items.get(user_id)
+        return adj if adj is not None and adj.expires > time.monotonic() else None
+
+    # Incremental updates: only users already cached are touched, nothing is reloaded
+    def on_request(self, sender_id, receiver_id):
+        with self._lock:
+            if adj := self._cached(sender_id): adj.outgoing.add(receiver_id)
+            if adj := self._cached(receiver_id): adj.incoming.add(sender_id)
+
+    def on_accept(self, sender_id, receiver_id):
+        with self._lock:
+            if adj := self._cached(sender_id):
+                adj.outgoing.discard(receiver_id)
+                adj.friends.add(receiver_id)
+            if adj := self._cached(receiver_id):
+                adj.incoming.discard(sender_id)
+                adj.friends.add(sender_id)
+
+    def on_remove(self, sender_id, receiver_id):
+        # Rejected request or removed friendship
+        with self._lock:
+            for a, b in ((sender_id, receiver_id), (receiver_id, sender_id)):
+                if adj := self._cached(a):
+                    adj.friends.discard(b)
+                    adj.incoming.discard(b)
+                    adj.outgoing.discard(b)
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None: self._items.clear()
+            else: self._items.pop(user_id, None)
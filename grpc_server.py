@@ -1,40 +1,223 @@
 import grpc
 from concurrent import futures
+import os
+import queue
+import sqlite3
+import threading
 import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import service_pb2
 import service_pb2_grpc
+from metrics import Registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
 
+# --- Config ---
+# Nguồn danh sách ban: file (mỗi dòng "user_id" hoặc "user_id lý do") hoặc bảng banned_user trong DB
+BANS_FILE = os.environ.get('BANS_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'banned_ids.txt'))
+BANS_DB = os.environ.get('BANS_DB')
+BANS_RELOAD_SECONDS = float(os.environ.get('BANS_RELOAD_SECONDS', '5'))
+
+# Metrics: GET http://<host>:METRICS_PORT/metrics (Prometheus); METRICS_ENABLED=0 tắt interceptor
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9101'))
+
+BANNED_MESSAGE = "Tài khoản của bạn đã bị khóa do vi phạm quy định."
+OK_MESSAGE = "Trạng thái hoạt động bình thường."
+
+# --- Ban State ---
+class BanRegistry:
+    def __init__(self):
+        self._banned = {}  # user_id -> lý do
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def status(self, user_id):
+        reason = self._banned.get(user_id)
+        if reason is None: return False, OK_MESSAGE
+        return True, reason
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._banned)
+
+    def replace(self, banned):
+        # Thay toàn bộ danh sách và phát các thay đổi (delta) tới các stream đang theo dõi
+        with self._lock:
+            old = self._banned
+            changes = [(uid, True, reason) for uid, reason in banned.items() if old.get(uid) != reason]
+            changes += [(uid, False, '') for uid in old if uid not in banned]
+            self._banned = banned
+            for q in self._subscribers:
+                for change in changes: q.put(change)
+        for uid, is_banned, _ in changes:
+            print(f"[gRPC] User {uid} {'bị khóa' if is_banned else 'được mở khóa'}")
+
+    def subscribe(self):
+        q = queue.Queue()
+        with self._lock:
+            self._subscribers.add(q)
+            return q, dict(self._banned)
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+
+def load_bans_from_file(path):
+    banned = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line: continue
+            uid, _, reason = line.partition(' ')
+            banned[int(uid)] = reason.strip() or BANNED_MESSAGE
+    return banned
+
+
+def load_bans_from_db(path):
+    with sqlite3.connect(f'file:{path}?mode=ro', uri=True) as conn:
+        rows = conn.execute('SELECT user_id, reason FROM banned_user').fetchall()
+    return {uid: reason or BANNED_MESSAGE for uid, reason in rows}
+
+
+def watch_ban_source(registry, stop_event):
+    last_mtime = None
+    while not stop_event.is_set():
+        try:
+            if BANS_DB:
+                registry.replace(load_bans_from_db(BANS_DB))
+            elif os.path.exists(BANS_FILE):
+                mtime = os.path.getmtime(BANS_FILE)
+                if mtime != last_mtime:
+                    registry.replace(load_bans_from_file(BANS_FILE))
+                    last_mtime = mtime
+        except (OSError, ValueError, sqlite3.Error) as e:
+            print(f"[gRPC] Không tải được danh sách ban: {e}")
+        stop_event.wait(BANS_RELOAD_SECONDS)
+
+
+# --- Metrics ---
+server_metrics = Registry()
+rpc_latency = server_metrics.histogram('grpc_server_handling_seconds', 'Unary RPC latency', ('method',))
+rpc_handled = server_metrics.counter('grpc_server_handled_total', 'Finished RPCs by status code', ('method', 'code'))
+active_streams = {}  # method -> open server-streaming calls
+_streams_lock = threading.Lock()
+server_metrics.gauge('grpc_server_active_streams', 'Open server-streaming RPCs', lambda: {(m,): n for m, n in active_streams.items()}, ('method',))
+
+
+class MetricsInterceptor(grpc.ServerInterceptor):
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None: return handler
+        method = handler_call_details.method.rsplit('/', 1)[-1]
+        if handler.unary_unary:
+            return grpc.unary_unary_rpc_method_handler(
+                self._timed(method, handler.unary_unary),
+                request_deserializer=handler.request_deserializer, response_serializer=handler.response_serializer)
+        if handler.unary_stream:
+            return grpc.unary_stream_rpc_method_handler(
+                self._streamed(method, handler.unary_stream),
+                request_deserializer=handler.request_deserializer, response_serializer=handler.response_serializer)
+        return handler
+
+    def _timed(self, method, behavior):
+        def wrapper(request, context):
+            start = time.perf_counter()
+            code = None
+            try:
+                return behavior(request, context)
+            except Exception:
+                code = context.code() or grpc.StatusCode.UNKNOWN
+                raise
+            finally:
+                rpc_latency.observe(time.perf_counter() - start, method)
+                rpc_handled.inc(method, (code or context.code() or grpc.StatusCode.OK).name)
+        return wrapper
+
+    def _streamed(self, method, behavior):
+        def wrapper(request, context):
+            with _streams_lock: active_streams[method] = active_streams.get(method, 0) + 1
+            code = None
+            try:
+                yield from behavior(request, context)
+            except Exception:
+                code = context.code() or grpc.StatusCode.UNKNOWN
+                raise
+            finally:
+                with _streams_lock: active_streams[method] -= 1
+                rpc_handled.inc(method, (code or context.code() or grpc.StatusCode.OK).name)
+        return wrapper
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = server_metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# --- Service ---
 class UserValidationService(service_pb2_grpc.UserValidationServicer):
+    def __init__(self, registry):
+        self.registry = registry
+
     def CheckUserStatus(self, request, context):
         print(f"[gRPC] Đang kiểm tra User ID: {request.user_id} ({request.username})")
-        
-        # --- LOGIC KIỂM TRA ---
-        BANNED_IDS = [2] 
-        
-        if request.user_id in BANNED_IDS:
-            return service_pb2.UserResponse(
-                is_banned=True, 
-                message="Tài khoản của bạn đã bị khóa do vi phạm quy định."
-            )
-        else:
-            return service_pb2.UserResponse(
-                is_banned=False, 
-                message="Trạng thái hoạt động bình thường."
-            )
+        is_banned, message = self.registry.status(request.user_id)
+        return service_pb2.UserResponse(is_banned=is_banned, message=message)
+
+    def CheckUserStatusBatch(self, request, context):
+        statuses = []
+        for u in request.users:
+            is_banned, message = self.registry.status(u.user_id)
+            statuses.append(service_pb2.UserStatus(user_id=u.user_id, is_banned=is_banned, message=message))
+        return service_pb2.UserBatchResponse(statuses=statuses)
+
+    def WatchBanChanges(self, request, context):
+        q, snapshot = self.registry.subscribe()
+        try:
+            for uid, reason in snapshot.items():
+                yield service_pb2.BanChange(user_id=uid, is_banned=True, message=reason)
+            yield service_pb2.BanChange(snapshot_done=True)
+            while context.is_active():
+                try: uid, is_banned, message = q.get(timeout=1.0)
+                except queue.Empty: continue
+                yield service_pb2.BanChange(user_id=uid, is_banned=is_banned, message=message)
+        finally:
+            self.registry.unsubscribe(q)
 
 def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    service_pb2_grpc.add_UserValidationServicer_to_server(UserValidationService(), server)
-    
+    registry = BanRegistry()
+    stop_event = threading.Event()
+    threading.Thread(target=watch_ban_source, args=(registry, stop_event), daemon=True).start()
+
+    # Mỗi stream WatchBanChanges giữ một worker, nên cần nhiều worker hơn số MainServer
+    interceptors = [MetricsInterceptor()] if METRICS_ENABLED else []
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=32), interceptors=interceptors)
+    service_pb2_grpc.add_UserValidationServicer_to_server(UserValidationService(registry), server)
+
     # Chạy trên port 50051
     server.add_insecure_port('[::]:50051')
     print("[gRPC Microservice] Validation Server đang chạy trên port 50051...")
     server.start()
+    if METRICS_ENABLED:
+        metrics_server = ThreadingHTTPServer(('', METRICS_PORT), MetricsHandler)
+        threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+        print(f"[gRPC Microservice] Metrics: http://127.0.0.1:{METRICS_PORT}/metrics")
     try:
         while True:
             time.sleep(86400)
     except KeyboardInterrupt:
+        stop_event.set()
         server.stop(0)
 
 if __name__ == '__main__':
-    serve()
\ No newline at end of file
+    serve()
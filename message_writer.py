@@ -0,0 +1,261 @@
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import insert
+from models import db, Message, update_conversations, update_delivery_cursors
+from async_support import in_thread
+
+# --- Write-behind persistence for chat messages ---
+# Messages get their id up front and are queued; a background thread commits them
+# in batches (one transaction / fsync per batch instead of per message), together with
+# the Conversation summaries they update and the delivered watermarks acked since the
+# last batch (coalesced in memory, written at least every cursor_flush_ms).
+
+DURABILITY_FLUSH = 'flush'      # ack (emit) only after the batch containing the message is committed
+DURABILITY_ENQUEUE = 'enqueue'  # ack as soon as the message is queued
+
+
+class SnowflakeIds:
+    # 41 bits of milliseconds since EPOCH_MS | 10 bits worker id | 12 bits sequence.
+    # Unique across MainServer workers without coordination (each needs its own
+    # worker id) and roughly time-ordered, which keeps id cursors chronological.
+    EPOCH_MS = 1704067200000  # 2024-01-01 UTC
+    WORKER_BITS = 10
+    SEQUENCE_BITS = 12
+
+    def __init__(self, worker_id=0):
+        if not 0 <= worker_id < (1 << self.WORKER_BITS):
+            raise ValueError(f"worker_id must be in [0, {1 << self.WORKER_BITS})")
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            now = int(time.time() * 1000)
+            if now < self._last_ms: now = self._last_ms  # clock stepped back: keep ids increasing
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & ((1 << self.SEQUENCE_BITS) - 1)
+                if self._sequence == 0:
+                    while now <= self._last_ms: now = int(time.time() * 1000)
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return ((now - self.EPOCH_MS) << (self.WORKER_BITS + self.SEQUENCE_BITS)) \
+                | (self.worker_id << self.SEQUENCE_BITS) | self._sequence
+
+
+class WriterBusy(Exception):
+    pass
+
+
+class WriteFailed(Exception):
+    pass
+
+
+class _Pending:
+    __slots__ = ('row', 'done', 'error', 'queued_at')
+
+    def __init__(self, row, wait):
+        self.row = row
+        self.done = threading.Event() if wait else None
+        self.error = None
+        self.queued_at = time.monotonic()
+
+
+class MessageWriter:
+    def __init__(self, app, batch_size=100, flush_ms=20, queue_size=10000,
+                 durability=DURABILITY_ENQUEUE, put_timeout=0.5, worker_id=0, on_commit=None,
+                 cursor_flush_ms=1000, on_failed=None, wait_timeout=10):
+        if durability not in (DURABILITY_FLUSH, DURABILITY_ENQUEUE):
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000.0
+        self.durability = durability
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.ids = SnowflakeIds(worker_id)
+        self.on_commit = on_commit  # on_commit(commit_seconds, [submit->commit seconds per persisted message])
+        self.on_failed = on_failed  # on_failed(row, error): an 'enqueue' message (already emitted) was not saved
+        self.wait_timeout = wait_timeout  # 'flush' mode: longest wait for the batch commit
+        self.cursor_flush_interval = cursor_flush_ms / 1000.0
+        self._cursors = {}  # (user_id, device_id) -> delivered_id not written yet
+        self._inflight = {}  # same, taken by a transaction that has not committed yet
+        self._cursor_lock = threading.Lock()
+        self._queued = {}  # ids submitted and not committed/failed yet, oldest first
+        self._progress = threading.Condition()  # guards _queued; notified as batches finish
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        with self._start_lock:
+            if self._thread: return
+            self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+            self._thread.start()
+
+    def submit(self, sender_id, receiver_id, content):
+        """Queue a message and return it as a transient Message with id/timestamp set.
+
+        Raises WriterBusy when the queue stays full for put_timeout (backpressure),
+        and WriteFailed in flush mode if the batch could not be committed.
+        """
+        if not self._thread: self.start()
+        with self._progress:  # ids enter _queued in order, so the first one is the oldest
+            row_id = self.ids.next_id()
+            self._queued[row_id] = None
+        row = {
+            'id': row_id,
+            'sender_id': sender_id,
+            'receiver_id': receiver_id,
+            'content': content,
+            'timestamp': datetime.now(timezone.utc).replace(tzinfo=None),
+        }
+        pending = _Pending(row, wait=self.durability == DURABILITY_FLUSH)
+        try:
+            self.queue.put(pending, timeout=self.put_timeout)
+        except queue.Full:
+            self._finished([row_id])
+            raise WriterBusy("Message queue is full")
+
+        if pending.done:
+            if not pending.done.wait(self.wait_timeout): raise WriteFailed("Timed out waiting for the commit")
+            if pending.error: raise WriteFailed(pending.error)
+        return Message(**row)
+
+    def note_delivered(self, user_id, device_id, delivered_id):
+        """Move a device's delivered watermark forward; written with the next batch.
+
+        Held below the oldest message still queued here: 'enqueue' mode emits (and devices ack)
+        messages before they are committed, and a drain only reads committed rows.
+        """
+        oldest = self.oldest_pending()
+        if oldest is not None: delivered_id = min(delivered_id, oldest - 1)
+        key = (user_id, device_id)
+        with self._cursor_lock:
+            if delivered_id > self._cursors.get(key, -1): self._cursors[key] = delivered_id
+
+    def delivered(self, user_id, device_id):
+        # Watermark noted or being written but not committed yet, or None
+        key = (user_id, device_id)
+        with self._cursor_lock:
+            noted = [c for c in (self._cursors.get(key), self._inflight.get(key)) if c is not None]
+        return max(noted, default=None)
+
+    def oldest_pending(self):
+        # Id of the oldest message queued but not committed (or failed) yet, or None
+        with self._progress: return next(iter(self._queued), None)
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far is committed (or failed). False on timeout."""
+        with self._progress:
+            last = next(reversed(self._queued), None)
+            if last is None: return True
+            return self._progress.wait_for(lambda: next(iter(self._queued), last + 1) > last, timeout)
+
+    def stop(self):
+        if not self._thread: return
+        self._stopping = True
+        self.flush()
+        if self._cursors: self._write([])
+
+    def _run(self):
+        while True:
+            try: first = self.queue.get(timeout=self.cursor_flush_interval)
+            except queue.Empty:
+                try:
+                    if self._cursors: in_thread(self._write, [])
+                except Exception as e:
+                    print(f"[Writer] Failed to save delivery cursors: {e}")
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stopping and self.queue.empty(): break
+                try: batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty: break
+            try:
+                in_thread(self._write, batch)  # the commit waits on the SQLite lock off the hub
+            except Exception as e:
+                # No session/connection: none of the batch is known to be saved
+                print(f"[Writer] Failed to persist a batch of {len(batch)}: {e}")
+                for p in batch: p.error = p.error or str(e)
+            finally:
+                # Always release the senders and flush(), or they would wait forever
+                self._finished([p.row['id'] for p in batch])
+                for p in batch:
+                    if p.done: p.done.set()
+                    elif p.error: self._report_failed(p)
+                    self.queue.task_done()
+
+    def _report_failed(self, pending):
+        if not self.on_failed: return
+        try: self.on_failed(pending.row, pending.error)
+        except Exception as e: print(f"[Writer] on_failed: {e}")
+
+    def _finished(self, ids):
+        with self._progress:
+            for row_id in ids: self._queued.pop(row_id, None)
+            self._progress.notify_all()
+
+    def _take_cursors(self):
+        # delivered() keeps seeing them until the transaction commits
+        with self._cursor_lock:
+            cursors, self._cursors = self._cursors, {}
+            for key, delivered_id in cursors.items():
+                if delivered_id > self._inflight.get(key, -1): self._inflight[key] = delivered_id
+        return cursors
+
+    def _settle_cursors(self, cursors, saved):
+        # Transaction over: drop them from the in-flight map, or queue them again to retry
+        with self._cursor_lock:
+            for key, delivered_id in cursors.items():
+                if self._inflight.get(key) == delivered_id: del self._inflight[key]
+                if not saved and delivered_id > self._cursors.get(key, -1): self._cursors[key] = delivered_id
+
+    def _write(self, batch):
+        start = time.monotonic()
+        cursors = self._take_cursors()
+        try:
+            with self.app.app_context():
+                try:
+                    rows = [p.row for p in batch]
+                    if rows:
+                        db.session.execute(insert(Message), rows)
+                        update_conversations(rows)
+                    update_delivery_cursors(cursors)
+                    db.session.commit()
+                    self._settle_cursors(cursors, saved=True)
+                except Exception:
+                    db.session.rollback()
+                    # Isolate the bad rows so one invalid message does not drop the whole batch
+                    for p in batch:
+                        try:
+                            db.session.execute(insert(Message), [p.row])
+                            update_conversations([p.row])
+                            db.session.commit()
+                        except Exception as e:
+                            db.session.rollback()
+                            p.error = str(e)
+                            print(f"[Writer] Failed to persist message {p.row['id']}: {e}")
+                    if cursors:
+                        try:
+                            update_delivery_cursors(cursors)
+                            db.session.commit()
+                            self._settle_cursors(cursors, saved=True)
+                        except Exception as e:
+                            db.session.rollback()
+                            self._settle_cursors(cursors, saved=False)  # retried with the next batch
+                            print(f"[Writer] Failed to save {len(cursors)} delivery cursors: {e}")
+        except Exception:
+            self._settle_cursors(cursors, saved=False)
+            raise
+        if not batch or not self.on_commit: return
+        end = time.monotonic()
+        try: self.on_commit(end - start, [end - p.queued_at for p in batch if not p.error])
+        except Exception as e: print(f"[Writer] on_commit: {e}")
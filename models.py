@@ -1,17 +1,28 @@
 import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from flask_bcrypt import Bcrypt
+from storage import configure_sqlite, install_sqlite_profile
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 app = Flask(__name__)
 bcrypt = Bcrypt(app)
 
-# Database Config
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'chat.db')
+# Database Config (see storage.py: WAL, one writer connection, read-only pool)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLITE_JOURNAL_MODE'] = 'WAL'
+app.config['SQLITE_SYNCHRONOUS'] = 'NORMAL'  # WAL + NORMAL: durable across app crashes, not power loss
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = 5000
+app.config['SQLITE_CACHE_SIZE_KB'] = 32 * 1024  # per connection
+app.config['SQLITE_MMAP_SIZE'] = 256 * 1024 * 1024
+app.config['SQLITE_READ_POOL_SIZE'] = 8
+app.config['SQLITE_POOL_TIMEOUT'] = 30  # seconds to wait for a free connection
+app.config['CHAT_DB'] = os.environ.get('CHAT_DB', os.path.join(basedir, 'chat.db'))
+configure_sqlite(app, app.config['CHAT_DB'])
 app.config['SECRET_KEY'] = 'my-super-secret-key-for-sessions'
+app.config['AVATAR_STORE_DIR'] = os.path.join(basedir, 'avatars')
 
 # JWT Config
 app.config["JWT_TOKEN_LOCATION"] = ["headers"]
@@ -19,9 +30,18 @@ app.config["JWT_HEADER_NAME"] = "Authorization"
 app.config["JWT_HEADER_TYPE"] = "Bearer"
 
 db = SQLAlchemy(app)
+read_session = install_sqlite_profile(app, db)  # for GET endpoints; db.session is the writer
 
 # --- Models ---
 
+def search_key(text):
+    # Case folding for prefix search, done in Python: SQLite's lower() only folds ASCII,
+    # so 'Đức' or 'Élise' would never match a lower-case query
+    return text.casefold() if isinstance(text, str) else text
+
+def _search_key_default(column):
+    return lambda ctx: search_key(ctx.get_current_parameters().get(column))
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -32,7 +52,17 @@ class User(db.Model):
     display_name = db.Column(db.String(100), nullable=False) 
     gender = db.Column(db.String(10)) 
     dob = db.Column(db.String(20))    
-    avatar_base64 = db.Column(db.Text, nullable=True)
+    avatar_base64 = db.Column(db.Text, nullable=True)  # Legacy: migrated to avatar_hash by create_db.py
+    avatar_hash = db.Column(db.String(64), nullable=True)  # Key in avatar_store.AvatarStore
+
+    # Prefix search for queries shorter than a trigram (see user_search below). Filled on
+    # insert; an UPDATE of display_name must set display_name_key too.
+    username_key = db.Column(db.String(80), default=_search_key_default('username'))
+    display_name_key = db.Column(db.String(100), default=_search_key_default('display_name'))
+    __table_args__ = (
+        db.Index('ix_user_username_key', username_key),
+        db.Index('ix_user_display_name_key', display_name_key),
+    )
 
     def __repr__(self):
         return f'<User {self.username}>'
@@ -46,7 +76,11 @@ class Friendship(db.Model):
     sender = db.relationship('User', foreign_keys=[sender_id], backref='sent_requests')
     receiver = db.relationship('User', foreign_keys=[receiver_id], backref='received_requests')
 
-    __table_args__ = (db.UniqueConstraint('sender_id', 'receiver_id', name='unique_friend_request'),)
+    __table_args__ = (
+        db.UniqueConstraint('sender_id', 'receiver_id', name='unique_friend_request'),
+        # The unique constraint covers lookups by sender; this one covers the receiver side
+        db.Index('ix_friendship_receiver', 'receiver_id', 'status'),
+    )
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -59,5 +93,117 @@ class Message(db.Model):
     sender = db.relationship('User', foreign_keys=[sender_id], backref='sent_messages')
     receiver = db.relationship('User', foreign_keys=[receiver_id], backref='received_messages')
 
+    # Conversation index: each direction of a chat is one range scan ordered by id.
+    # Sender/receiver indexes serve the delta sync across all of a user's conversations.
+    __table_args__ = (
+        db.Index('ix_message_conversation', 'sender_id', 'receiver_id', 'id'),
+        db.Index('ix_message_sender', 'sender_id', 'id'),
+        db.Index('ix_message_receiver', 'receiver_id', 'id'),
+    )
+
     def __repr__(self):
-        return f'<Message {self.id}>'
\ No newline at end of file
+        return f'<Message {self.id}>'
+
+# --- Conversation summaries ---
+# One row per user pair (user_a_id < user_b_id) with the last message and each side's unread
+# count, so the inbox is one indexed read per user instead of a GROUP BY over message.
+# Rows are upserted by the message writer in the same transaction as the messages.
+PREVIEW_LENGTH = 100
+
+class Conversation(db.Model):
+    user_a_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    user_b_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    last_message_id = db.Column(db.Integer, nullable=False)
+    last_sender_id = db.Column(db.Integer, nullable=False)
+    last_preview = db.Column(db.String(PREVIEW_LENGTH), nullable=False)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    unread_a = db.Column(db.Integer, nullable=False, default=0)  # messages to user_a not read yet
+    unread_b = db.Column(db.Integer, nullable=False, default=0)
+    read_upto_a = db.Column(db.Integer, nullable=False, default=0)  # last message id user_a has read
+    read_upto_b = db.Column(db.Integer, nullable=False, default=0)
+
+    # Inbox: one range scan per side, newest first
+    __table_args__ = (
+        db.Index('ix_conversation_user_a', 'user_a_id', 'last_message_id'),
+        db.Index('ix_conversation_user_b', 'user_b_id', 'last_message_id'),
+    )
+
+def conversation_key(user_x, user_y):
+    return (user_x, user_y) if user_x < user_y else (user_y, user_x)
+
+def update_conversations(rows):
+    """Fold new message rows into their Conversation summaries; the caller commits.
+
+    One upsert per message: its receiver's unread count only grows if the message is newer
+    than what that side has marked read (a read can land before a queued message commits).
+    """
+    params = []
+    for r in rows:
+        a, b = conversation_key(r['sender_id'], r['receiver_id'])
+        params.append({
+            'user_a_id': a, 'user_b_id': b,
+            'last_message_id': r['id'], 'last_sender_id': r['sender_id'],
+            'last_preview': r['content'][:PREVIEW_LENGTH], 'last_timestamp': r['timestamp'],
+            'unread_a': int(r['receiver_id'] == a and a != b), 'unread_b': int(r['receiver_id'] == b and a != b),
+        })
+    if not params: return
+    stmt = sqlite_insert(Conversation)
+    new = stmt.excluded
+    newer = new.last_message_id > Conversation.last_message_id
+    stmt = stmt.on_conflict_do_update(index_elements=['user_a_id', 'user_b_id'], set_={
+        'last_message_id': db.case((newer, new.last_message_id), else_=Conversation.last_message_id),
+        'last_sender_id': db.case((newer, new.last_sender_id), else_=Conversation.last_sender_id),
+        'last_preview': db.case((newer, new.last_preview), else_=Conversation.last_preview),
+        'last_timestamp': db.case((newer, new.last_timestamp), else_=Conversation.last_timestamp),
+        'unread_a': Conversation.unread_a + db.case((new.last_message_id > Conversation.read_upto_a, new.unread_a), else_=0),
+        'unread_b': Conversation.unread_b + db.case((new.last_message_id > Conversation.read_upto_b, new.unread_b), else_=0),
+    })
+    db.session.execute(stmt, params)
+
+class DeliveryCursor(db.Model):
+    # Delivered watermark per recipient device: every message to or from user_id with an id up
+    # to delivered_id has been acknowledged by that device. device_id '' = clients without one.
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    device_id = db.Column(db.String(64), primary_key=True, default='')
+    delivered_id = db.Column(db.Integer, nullable=False, default=0)
+
+def update_delivery_cursors(cursors):
+    """Upsert {(user_id, device_id): delivered_id}; a watermark only moves forward. The caller commits."""
+    if not cursors: return
+    stmt = sqlite_insert(DeliveryCursor)
+    stmt = stmt.on_conflict_do_update(index_elements=['user_id', 'device_id'], set_={
+        'delivered_id': db.func.max(DeliveryCursor.delivered_id, stmt.excluded.delivered_id),
+    })
+    db.session.execute(stmt, [{'user_id': u, 'device_id': d, 'delivered_id': c} for (u, d), c in cursors.items()])
+
+class BannedUser(db.Model):
+    # Read by grpc_server.py (BANS_DB) as the source of ban state
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    reason = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+
+# --- Search Index ---
+# FTS5 trigram index over username/display_name, kept in sync with the user table by
+# triggers. Matches any substring of 3+ characters, case-insensitively.
+USER_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5(
+        username, display_name, content='user', content_rowid='id', tokenize='trigram')""",
+    """CREATE TRIGGER IF NOT EXISTS user_search_ai AFTER INSERT ON user BEGIN
+        INSERT INTO user_search(rowid, username, display_name) VALUES (new.id, new.username, new.display_name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS user_search_ad AFTER DELETE ON user BEGIN
+        INSERT INTO user_search(user_search, rowid, username, display_name) VALUES ('delete', old.id, old.username, old.display_name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS user_search_au AFTER UPDATE OF username, display_name ON user BEGIN
+        INSERT INTO user_search(user_search, rowid, username, display_name) VALUES ('delete', old.id, old.username, old.display_name);
+        INSERT INTO user_search(rowid, username, display_name) VALUES (new.id, new.username, new.display_name);
+    END""",
+]
+
+def install_search_index():
+    with db.engine.begin() as conn:
+        exists = conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'user_search'").first()
+        for stmt in USER_SEARCH_DDL:
+            conn.exec_driver_sql(stmt)
+        if not exists:
+            conn.exec_driver_sql("INSERT INTO user_search(user_search) VALUES ('rebuild')")
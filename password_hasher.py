@@ -0,0 +1,96 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+# --- Password hashing off the request thread ---
+# bcrypt is ~100-300 ms of pure CPU per call. Running it in a process pool keeps the
+# server's threads (and its GIL) free for Socket.IO traffic, and a bound on in-flight
+# jobs turns overload into a fast 503 instead of an ever-growing backlog.
+
+BCRYPT_MAX_BYTES = 72  # bcrypt only reads the first 72 bytes; bcrypt>=5 rejects longer input
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def _encode(password):
+    return password.encode('utf-8')[:BCRYPT_MAX_BYTES]
+
+
+# Module-level so the pool workers can import them
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(_encode(password), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check_password(password, hashed):
+    try:
+        return bcrypt.checkpw(_encode(password), hashed.encode('utf-8'))
+    except ValueError:
+        return False
+
+
+def hash_rounds(hashed):
+    # "$2b$12$<salt+hash>" -> 12
+    try: return int(hashed.split('$')[2])
+    except (IndexError, ValueError): return None
+
+
+def pool_context():
+    # Forking a server that already runs gRPC/socket threads is unsafe, so workers come
+    # from a clean forkserver (or spawn on Windows). Either way each worker imports the
+    # main script once as __mp_main__, so the server always starts from serve.py, whose
+    # module level only defines functions.
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload([__name__])
+        return ctx
+    return multiprocessing.get_context('spawn')
+
+
+class PasswordHasher:
+    def __init__(self, rounds=12, workers=None, max_pending=None, timeout=30.0):
+        self.rounds = rounds
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 4
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(self.workers, mp_context=pool_context())
+        return self._pool
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy("Too many password operations in progress")
+        try:
+            future = self._executor().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result(timeout=self.timeout)
+
+    def hash(self, password):
+        return self._run(_hash_password, password, self.rounds)
+
+    def check(self, password, hashed):
+        return self._run(_check_password, password, hashed)
+
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
+
+    def warm_up(self):
+        # Start the worker processes now rather than on the first login
+        list(self._executor().map(int, range(self.workers)))
+
+    def close(self):
+        if self._pool: self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,83 @@
+import argparse
+import os
+import signal
+import subprocess
+import sys
+
+# --- Production entry point for MainServer ---
+# python serve.py --mode gevent --host 0.0.0.0 --port 8000 [--workers 4]
+#
+# gevent (recommended) or eventlet serve every socket from a green thread, so one process
+# holds tens of thousands of idle websockets. 'threading' is the Werkzeug dev server
+# (`python MainServer.py` runs it with --debug for the reloader and debugger).
+# With --workers N the workers listen on port, port+1, ... and share the Socket.IO
+# Socket.IO message queue; put a load balancer with sticky sessions in front.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run MainServer")
+    parser.add_argument('--mode', choices=['gevent', 'eventlet', 'threading'], default=os.environ.get('CHAT_ASYNC_MODE', 'gevent'))
+    parser.add_argument('--host', default=os.environ.get('CHAT_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('CHAT_PORT', '8000')))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('CHAT_WORKERS', '1')))
+    parser.add_argument('--worker-id', type=int, default=int(os.environ.get('WORKER_ID', '0')))
+    parser.add_argument('--debug', action='store_true', help="Werkzeug reloader and debugger (threading mode)")
+    return parser.parse_args()
+
+
+def raise_fd_limit():
+    # Every socket is a file descriptor; the default soft limit (often 1024) caps connections
+    try:
+        import resource
+    except ImportError:  # Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY: hard = 1 << 20
+    if soft < hard: resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run_worker(args):
+    os.environ['CHAT_ASYNC_MODE'] = args.mode
+    os.environ['WORKER_ID'] = str(args.worker_id)
+    if args.mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+        import grpc.experimental.gevent
+        grpc.experimental.gevent.init_gevent()
+    elif args.mode == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    raise_fd_limit()
+
+    import MainServer
+    MainServer.start_background_services()
+    print(f"[Worker {args.worker_id}] {args.mode} server running on http://{args.host}:{args.port}")
+    MainServer.socketio.run(MainServer.app, host=args.host, port=args.port, log_output=False,
+                            debug=args.debug, allow_unsafe_werkzeug=args.mode == 'threading')
+
+
+def run_workers(args):
+    env = dict(os.environ)
+    # Workers must share delivery; default to the local SQLite message bus
+    env.setdefault('SOCKETIO_MESSAGE_QUEUE', 'sqlite:///' + os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bus.db'))
+
+    procs = []
+    for i in range(args.workers):
+        cmd = [sys.executable, os.path.abspath(__file__), '--mode', args.mode, '--host', args.host,
+               '--port', str(args.port + i), '--workers', '1', '--worker-id', str(args.worker_id + i)]
+        procs.append(subprocess.Popen(cmd, env=env))
+
+    def stop(*_):
+        for p in procs: p.terminate()
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for p in procs: p.wait()
+    except KeyboardInterrupt:
+        stop()
+        for p in procs: p.wait()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.workers > 1: run_workers(args)
+    else: run_worker(args)
@@ -24,7 +24,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rservice.proto\"0\n\x0bUserRequest\x12\x0f\n\x07user_id\x18\x01 \x01(\x05\x12\x10\n\x08username\x18\x02 \x01(\t\"2\n\x0cUserResponse\x12\x11\n\tis_banned\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t2B\n\x0eUserValidation\x12\x30\n\x0f\x43heckUserStatus\x12\x0c.UserRequest\x1a\r.UserResponse\"\x00\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rservice.proto\"0\n\x0bUserRequest\x12\x0f\n\x07user_id\x18\x01 \x01(\x05\x12\x10\n\x08username\x18\x02 \x01(\t\"2\n\x0cUserResponse\x12\x11\n\tis_banned\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\"/\n\x10UserBatchRequest\x12\x1b\n\x05users\x18\x01 \x03(\x0b\x32\x0c.UserRequest\"A\n\nUserStatus\x12\x0f\n\x07user_id\x18\x01 \x01(\x05\x12\x11\n\tis_banned\x18\x02 \x01(\x08\x12\x0f\n\x07message\x18\x03 \x01(\t\"2\n\x11UserBatchResponse\x12\x1d\n\x08statuses\x18\x01 \x03(\x0b\x32\x0b.UserStatus\"\x0e\n\x0cWatchRequest\"W\n\tBanChange\x12\x0f\n\x07user_id\x18\x01 \x01(\x05\x12\x11\n\tis_banned\x18\x02 \x01(\x08\x12\x0f\n\x07message\x18\x03 \x01(\t\x12\x15\n\rsnapshot_done\x18\x04 \x01(\x08\x32\xb5\x01\n\x0eUserValidation\x12\x30\n\x0f\x43heckUserStatus\x12\x0c.UserRequest\x1a\r.UserResponse\"\x00\x12?\n\x14\x43heckUserStatusBatch\x12\x11.UserBatchRequest\x1a\x12.UserBatchResponse\"\x00\x12\x30\n\x0fWatchBanChanges\x12\r.WatchRequest\x1a\n.BanChange\"\x00\x30\x01\x62\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -35,6 +35,16 @@ if not _descriptor._USE_C_DESCRIPTORS:
   _globals['_USERREQUEST']._serialized_end=65
   _globals['_USERRESPONSE']._serialized_start=67
   _globals['_USERRESPONSE']._serialized_end=117
-  _globals['_USERVALIDATION']._serialized_start=119
-  _globals['_USERVALIDATION']._serialized_end=185
+  _globals['_USERBATCHREQUEST']._serialized_start=119
+  _globals['_USERBATCHREQUEST']._serialized_end=166
+  _globals['_USERSTATUS']._serialized_start=168
+  _globals['_USERSTATUS']._serialized_end=233
+  _globals['_USERBATCHRESPONSE']._serialized_start=235
+  _globals['_USERBATCHRESPONSE']._serialized_end=285
+  _globals['_WATCHREQUEST']._serialized_start=287
+  _globals['_WATCHREQUEST']._serialized_end=301
+  _globals['_BANCHANGE']._serialized_start=303
+  _globals['_BANCHANGE']._serialized_end=390
+  _globals['_USERVALIDATION']._serialized_start=393
+  _globals['_USERVALIDATION']._serialized_end=574
 # @@protoc_insertion_point(module_scope)
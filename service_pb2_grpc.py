@@ -39,6 +39,16 @@ class UserValidationStub(object):
                 request_serializer=service__pb2.UserRequest.SerializeToString,
                 response_deserializer=service__pb2.UserResponse.FromString,
                 _registered_method=True)
+        self.CheckUserStatusBatch = channel.unary_unary(
+                '/UserValidation/CheckUserStatusBatch',
+                request_serializer=service__pb2.UserBatchRequest.SerializeToString,
+                response_deserializer=service__pb2.UserBatchResponse.FromString,
+                _registered_method=True)
+        self.WatchBanChanges = channel.unary_stream(
+                '/UserValidation/WatchBanChanges',
+                request_serializer=service__pb2.WatchRequest.SerializeToString,
+                response_deserializer=service__pb2.BanChange.FromString,
+                _registered_method=True)
 
 
 class UserValidationServicer(object):
@@ -51,6 +61,20 @@ class UserValidationServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def CheckUserStatusBatch(self, request, context):
+        """Kiểm tra nhiều user trong một lần gọi
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def WatchBanChanges(self, request, context):
+        """Stream danh sách ban hiện tại, sau đó là các thay đổi ban/unban
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_UserValidationServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -59,6 +83,16 @@ def add_UserValidationServicer_to_server(servicer, server):
                     request_deserializer=service__pb2.UserRequest.FromString,
                     response_serializer=service__pb2.UserResponse.SerializeToString,
             ),
+            'CheckUserStatusBatch': grpc.unary_unary_rpc_method_handler(
+                    servicer.CheckUserStatusBatch,
+                    request_deserializer=service__pb2.UserBatchRequest.FromString,
+                    response_serializer=service__pb2.UserBatchResponse.SerializeToString,
+            ),
+            'WatchBanChanges': grpc.unary_stream_rpc_method_handler(
+                    servicer.WatchBanChanges,
+                    request_deserializer=service__pb2.WatchRequest.FromString,
+                    response_serializer=service__pb2.BanChange.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'UserValidation', rpc_method_handlers)
@@ -96,3 +130,57 @@ class UserValidation(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def CheckUserStatusBatch(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/UserValidation/CheckUserStatusBatch',
+            service__pb2.UserBatchRequest.SerializeToString,
+            service__pb2.UserBatchResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def WatchBanChanges(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/UserValidation/WatchBanChanges',
+            service__pb2.WatchRequest.SerializeToString,
+            service__pb2.BanChange.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
@@ -0,0 +1,67 @@
+import pickle
+import sqlite3
+import threading
+import time
+
+from socketio import PubSubManager
+
+# --- SQLite message bus for Socket.IO ---
+# A local stand-in for Redis: every MainServer worker on the host appends the
+# emits it makes to one SQLite table and tails it for the emits of the others.
+
+
+class SqliteBusManager(PubSubManager):
+    name = 'sqlite'
+
+    def __init__(self, path, channel='socketio', poll_interval=0.02, retention=60.0,
+                 write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        # One shared connection: under gevent/eventlet threading.local is per greenlet,
+        # which would open a connection for every socket handler
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._last_cleanup = 0.0
+        self._execute("""CREATE TABLE IF NOT EXISTS socketio_bus (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, payload BLOB NOT NULL, created REAL NOT NULL)""")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _execute(self, sql, params=()):
+        with self._db_lock:
+            if self._db is None: self._db = self._connect()
+            return self._db.execute(sql, params).fetchall()
+
+    def _publish(self, data):
+        now = time.time()
+        self._execute("INSERT INTO socketio_bus (channel, payload, created) VALUES (?, ?, ?)",
+                      (self.channel, pickle.dumps(data), now))  # pickle, like the redis manager: payloads may be bytes
+        if now - self._last_cleanup > self.retention:
+            self._last_cleanup = now
+            self._execute("DELETE FROM socketio_bus WHERE created < ?", (now - self.retention,))
+
+    def _listen(self):
+        conn = self._connect()  # the listener polls on its own connection
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM socketio_bus").fetchone()[0]
+        while True:
+            rows = conn.execute("SELECT id, payload FROM socketio_bus WHERE id > ? AND channel = ? ORDER BY id",
+                                (last_id, self.channel)).fetchall()
+            for row_id, payload in rows:
+                last_id = row_id
+                yield pickle.loads(payload)
+            if not rows: self.server.sleep(self.poll_interval)
+
+
+def create_client_manager(url):
+    """Return the Socket.IO client manager kwargs for a message queue URL ('' = single process)."""
+    if not url: return {}
+    if url.startswith('sqlite:///'):
+        return {'client_manager': SqliteBusManager(url[len('sqlite:///'):])}
+    # redis://, amqp://, kafka://, zmq+tcp:// ... are handled by Flask-SocketIO itself
+    return {'message_queue': url}
@@ -0,0 +1,93 @@
+import re
+import time
+from collections import Counter
+
+from flask import g, has_request_context
+from sqlalchemy import event
+
+# --- SQL profiler / N+1 detector (opt-in) ---
+# Times every statement on the given engines and attributes it to the current HTTP request
+# or Socket.IO event (anything running in a Flask request context). At the end of each
+# request/event the profile is checked against a budget: total statements, repeats of the
+# same statement shape (the N+1 signature: one query per item of a loop) and DB time.
+# Over budget -> a '[SQL]' log line, or QueryBudgetExceeded with action='raise' (tests/dev).
+
+ACTION_LOG = 'log'
+ACTION_RAISE = 'raise'
+
+_WHITESPACE = re.compile(r'\s+')
+_PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')  # IN (?, ?, ?) -> IN (?+)
+
+
+def statement_shape(statement):
+    return _PLACEHOLDER_LIST.sub('?+', _WHITESPACE.sub(' ', statement).strip())
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryProfile:
+    __slots__ = ('count', 'db_seconds', 'shapes')
+
+    def __init__(self):
+        self.count = 0
+        self.db_seconds = 0.0
+        self.shapes = Counter()
+
+    def repeated(self):
+        return [(shape, n) for shape, n in self.shapes.most_common() if n > 1]
+
+    def server_timing(self):
+        return f'db;dur={self.db_seconds * 1000:.2f};desc="{self.count} queries"'
+
+
+class SqlProfiler:
+    def __init__(self, max_queries=None, max_repeats=None, max_db_ms=None, action=ACTION_LOG):
+        if action not in (ACTION_LOG, ACTION_RAISE):
+            raise ValueError(f"Unknown SQL profile action: {action}")
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats
+        self.max_db_ms = max_db_ms
+        self.action = action
+
+    def install(self, engines):
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._before)
+            event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        profile = g.get('sql_profile') if has_request_context() else None
+        if profile is None: return  # background work (message writer, startup)
+        profile.count += 1
+        profile.db_seconds += elapsed
+        profile.shapes[statement_shape(statement)] += 1
+
+    def start(self):
+        g.sql_profile = QueryProfile()
+
+    def finish(self, label):
+        """End the current profile, enforce the budget and return it (None if none was started)."""
+        profile = g.pop('sql_profile', None)
+        if profile is None: return None
+        problems = self.check(profile)
+        if problems:
+            report = f"[SQL] {label}: {profile.count} queries, {profile.db_seconds * 1000:.1f} ms DB; " + '; '.join(problems)
+            if self.action == ACTION_RAISE: raise QueryBudgetExceeded(report)
+            print(report)
+        return profile
+
+    def check(self, profile):
+        problems = []
+        if self.max_queries is not None and profile.count > self.max_queries:
+            problems.append(f"over the budget of {self.max_queries} queries")
+        if self.max_db_ms is not None and profile.db_seconds * 1000 > self.max_db_ms:
+            problems.append(f"over the budget of {self.max_db_ms} ms")
+        if self.max_repeats is not None:
+            for shape, n in profile.repeated():
+                if n > self.max_repeats: problems.append(f"{n}x {shape[:200]}")
+        return problems
@@ -0,0 +1,88 @@
+import os
+
+from flask.globals import app_ctx
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+# --- SQLite storage profile ---
+# chat.db runs in WAL mode, so readers never wait behind the writer (and vice versa).
+# Writes go through a single dedicated connection: SQLite only allows one writer anyway,
+# and waiting for the pool is cheaper than SQLITE_BUSY retries. GET endpoints read
+# through a pool of read-only connections on the 'read' bind via read_session.
+#
+# With one writer connection, code must not hold db.session open while it waits on
+# something slow (bcrypt, gRPC): do those lookups through read_session instead.
+
+READ_BIND = 'read'
+
+
+def sqlite_uri(path, read_only=False):
+    if not read_only: return 'sqlite:///' + path
+    # SQLite URIs want forward slashes; 'file:C:/...' still counts as absolute on Windows
+    return 'sqlite:///file:' + path.replace(os.sep, '/') + '?mode=ro&uri=true'
+
+
+def configure_sqlite(app, path):
+    """Set the engine options for the writer and the read bind. Call before SQLAlchemy(app)."""
+    app.config['SQLALCHEMY_DATABASE_URI'] = sqlite_uri(path)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 1, 'max_overflow': 0, 'pool_timeout': app.config['SQLITE_POOL_TIMEOUT'],
+    }
+    app.config['SQLALCHEMY_BINDS'] = {READ_BIND: {
+        'url': sqlite_uri(path, read_only=True),
+        'pool_size': app.config['SQLITE_READ_POOL_SIZE'], 'max_overflow': 0,
+        'pool_timeout': app.config['SQLITE_POOL_TIMEOUT'],
+    }}
+
+
+def connection_pragmas(config):
+    return [
+        f"PRAGMA busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT_MS'])}",
+        f"PRAGMA cache_size = {-int(config['SQLITE_CACHE_SIZE_KB'])}",  # negative = KiB
+        f"PRAGMA mmap_size = {int(config['SQLITE_MMAP_SIZE'])}",
+    ]
+
+
+def install_sqlite_profile(app, db):
+    """Apply the pragmas to every new connection and return the read-only scoped session."""
+    with app.app_context():
+        writer, reader = db.engines[None], db.engines[READ_BIND]
+    writer_pragmas = [
+        f"PRAGMA journal_mode = {app.config['SQLITE_JOURNAL_MODE']}",
+        f"PRAGMA synchronous = {app.config['SQLITE_SYNCHRONOUS']}",
+    ] + connection_pragmas(app.config)
+    reader_pragmas = ["PRAGMA query_only = ON"] + connection_pragmas(app.config)
+
+    # pysqlite's own transaction handling is switched off so the 'begin' hooks below decide
+    # how a transaction starts
+    @event.listens_for(writer, 'connect')
+    def _writer_connect(dbapi_conn, _record):
+        dbapi_conn.isolation_level = None
+        for pragma in writer_pragmas: dbapi_conn.execute(pragma)
+
+    @event.listens_for(writer, 'begin')
+    def _writer_begin(conn):
+        # Take the write lock up front: a deferred read->write upgrade can fail with
+        # SQLITE_BUSY immediately when another process committed in between
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+    @event.listens_for(reader, 'connect')
+    def _reader_connect(dbapi_conn, _record):
+        dbapi_conn.isolation_level = None
+        for pragma in reader_pragmas: dbapi_conn.execute(pragma)
+
+    @event.listens_for(reader, 'begin')
+    def _reader_begin(conn):
+        conn.exec_driver_sql('BEGIN')  # one snapshot per request
+
+    # journal_mode=WAL is persistent: create_db.py's first writer connection switches the file
+    # over (an older rollback-journal file on the first write). Nothing connects here, so
+    # importing the app does not create an empty chat.db.
+
+    read_session = scoped_session(sessionmaker(bind=reader), scopefunc=lambda: id(app_ctx._get_current_object()))
+
+    @app.teardown_appcontext
+    def _remove_read_session(exc):
+        read_session.remove()
+
+    return read_session
@@ -0,0 +1,202 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import grpc
+import service_pb2
+import service_pb2_grpc
+from async_support import offload
+
+# --- gRPC client for the UserValidation microservice ---
+# Long-lived channels (reused across connects) plus a TTL/LRU cache of ban verdicts.
+
+FAIL_OPEN = 'open'      # service unreachable -> let the user in (previous behaviour)
+FAIL_CLOSED = 'closed'  # service unreachable -> reject the connection
+
+UNAVAILABLE_MESSAGE = "Validation service unavailable, please try again later."
+
+
+class BanCache:
+    def __init__(self, ttl=30.0, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is None: return None
+            verdict, expires = item
+            if expires < time.monotonic():
+                del self._items[user_id]
+                return None
+            self._items.move_to_end(user_id)
+            return verdict
+
+    def put(self, user_id, verdict):
+        with self._lock:
+            self._items[user_id] = (verdict, time.monotonic() + self.ttl)
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None: self._items.clear()
+            else: self._items.pop(user_id, None)
+
+
+class UserValidationClient:
+    def __init__(self, target, timeout=2.0, pool_size=2, cache_ttl=30.0, cache_size=10000,
+                 fail_policy=FAIL_OPEN, on_rpc=None):
+        if fail_policy not in (FAIL_OPEN, FAIL_CLOSED):
+            raise ValueError(f"Unknown fail policy: {fail_policy}")
+        self.target = target
+        self.timeout = timeout
+        self.pool_size = max(1, pool_size)
+        self.fail_policy = fail_policy
+        self.cache = BanCache(cache_ttl, cache_size)
+        self.on_rpc = on_rpc  # on_rpc(method, seconds, status code name) after every unary call
+        self._channels = []
+        self._stubs = None
+        self._lock = threading.Lock()
+        # Local ban set fed by WatchBanChanges; only trusted while the stream is live
+        self._banned = {}
+        self._watch_ready = False
+        self._watch_thread = None
+        self._watch_call = None
+        self._closed = False
+
+    def _next_stub(self):
+        if self._stubs is None:
+            with self._lock:
+                if self._stubs is None:
+                    # A local subchannel pool gives every channel its own HTTP/2 connection
+                    options = [
+                        ('grpc.use_local_subchannel_pool', 1),
+                        ('grpc.keepalive_time_ms', 30000),
+                        ('grpc.keepalive_permit_without_calls', 1),
+                    ]
+                    self._channels = [grpc.insecure_channel(self.target, options=options) for _ in range(self.pool_size)]
+                    stubs = [service_pb2_grpc.UserValidationStub(ch) for ch in self._channels]
+                    self._stubs = itertools.cycle(stubs)
+        return next(self._stubs)
+
+    def _call(self, method, request):
+        if not self.on_rpc:
+            return offload(getattr(self._next_stub(), method), request, timeout=self.timeout)
+        start = time.monotonic()
+        code = grpc.StatusCode.OK
+        try:
+            return offload(getattr(self._next_stub(), method), request, timeout=self.timeout)
+        except grpc.RpcError as e:
+            code = e.code()
+            raise
+        finally:
+            self.on_rpc(method, time.monotonic() - start, code.name)
+
+    def check(self, user_id, username=''):
+        """Return (is_banned, message) for a user, served locally when possible."""
+        if self._watch_ready:
+            reason = self._banned.get(user_id)
+            return (reason is not None, reason or '')
+
+        cached = self.cache.get(user_id)
+        if cached is not None: return cached
+
+        try:
+            req = service_pb2.UserRequest(user_id=user_id, username=username)
+            resp = self._call('CheckUserStatus', req)
+        except grpc.RpcError as e:
+            print(f"[gRPC] CheckUserStatus failed for user {user_id}: {e.code()}")
+            return self._on_failure()
+
+        verdict = (resp.is_banned, resp.message)
+        self.cache.put(user_id, verdict)
+        return verdict
+
+    def check_many(self, users, apply_fail_policy=True):
+        """Check [(user_id, username), ...] in one round trip; returns {user_id: (is_banned, message)}.
+
+        With apply_fail_policy=False, users that could not be checked are left out of the result.
+        """
+        results, misses = {}, []
+        for user_id, username in users:
+            cached = self.check(user_id) if self._watch_ready else self.cache.get(user_id)
+            if cached is None: misses.append(service_pb2.UserRequest(user_id=user_id, username=username))
+            else: results[user_id] = cached
+        if not misses: return results
+
+        try:
+            resp = self._call('CheckUserStatusBatch', service_pb2.UserBatchRequest(users=misses))
+        except grpc.RpcError as e:
+            print(f"[gRPC] CheckUserStatusBatch failed for {len(misses)} users: {e.code()}")
+            if apply_fail_policy:
+                for req in misses: results[req.user_id] = self._on_failure()
+            return results
+
+        for status in resp.statuses:
+            verdict = (status.is_banned, status.message)
+            self.cache.put(status.user_id, verdict)
+            results[status.user_id] = verdict
+        return results
+
+    def start_watch(self, on_change, on_lost=None, max_backoff=30.0):
+        """Follow WatchBanChanges in a background thread.
+
+        on_change(user_id, is_banned, message) is called for every banned user in the
+        initial snapshot and for every later delta. on_lost() is called each time the
+        stream cannot be (re)established, while check() falls back to RPC + cache.
+        """
+        if self._watch_thread: return
+        self._watch_thread = threading.Thread(
+            target=self._watch_loop, args=(on_change, on_lost, max_backoff), name='ban-watch', daemon=True)
+        self._watch_thread.start()
+
+    def _watch_loop(self, on_change, on_lost, max_backoff):
+        backoff = 1.0
+        while not self._closed:
+            try:
+                self._watch_call = self._next_stub().WatchBanChanges(service_pb2.WatchRequest())
+                snapshot = {}
+                changes = iter(self._watch_call)
+                while (change := offload(next, changes, None)) is not None:
+                    if not self._watch_ready:
+                        if not change.snapshot_done:
+                            snapshot[change.user_id] = change.message
+                            continue
+                        self._banned = snapshot
+                        self._watch_ready = True
+                        self.cache.invalidate()
+                        backoff = 1.0
+                        for user_id, message in snapshot.items(): on_change(user_id, True, message)
+                        continue
+                    if change.is_banned: self._banned[change.user_id] = change.message
+                    else: self._banned.pop(change.user_id, None)
+                    self.cache.invalidate(change.user_id)
+                    on_change(change.user_id, change.is_banned, change.message)
+            except grpc.RpcError as e:
+                if self._closed: return
+                print(f"[gRPC] WatchBanChanges lost: {e.code()}")
+            self._watch_ready = False
+            if on_lost: on_lost()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, max_backoff)
+
+    def _on_failure(self):
+        if self.fail_policy == FAIL_CLOSED: return (True, UNAVAILABLE_MESSAGE)
+        return (False, '')
+
+    def invalidate(self, user_id=None):
+        self.cache.invalidate(user_id)
+
+    def close(self):
+        self._closed = True
+        self._watch_ready = False
+        if self._watch_call: self._watch_call.cancel()
+        with self._lock:
+            for ch in self._channels: ch.close()
+            self._channels = []
+            self._stubs = None